@@ -0,0 +1,235 @@
+import os
+import sys
+import cv2
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import subprocess
+import numpy as np
+import multiprocessing as mp
+from src.utils import CreateObject
+
+
+# python -m src.benchmark --sizes 64 128 256 --out bench.json
+# times every stage of the generation pipeline for each configuration of the
+# sweep, each in a fresh process so peak RSS is per configuration, and writes
+# the results as JSON. --compare old.json reports throughput changes and
+# exits non-zero on a regression beyond --tolerance. --imports instead reports
+# the cold import time of the generation modules, each measured in a fresh
+# interpreter.
+
+STAGES = ['rasterize', 'placement', 'composite', 'noise', 'normalize', 'encode', 'write']
+
+MIXED = ['circle', 'capsule', 'ellipse', 'square', 'pentagon', 'triangle']
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale/2**20
+
+
+def concept_types(shape, K, rng):
+    if shape == 'mixed':
+        return list(rng.choice(MIXED, size=K))
+    return [shape]*K
+
+
+def run_stages(config, rng, save_dir):
+    # one pass over every stage for a batch, {stage: seconds}
+    size, K, B = config['size'], config['Kconcepts'], config['batch_size']
+    creator = CreateObject(size, size)
+    background = (120, 90, 60)
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    start = time.perf_counter()
+    concepts = [creator.sample_sprites(B, type_, rng) for type_ in concept_types(config['shape'], K, rng)]
+    timings['rasterize'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    placement = creator.draw_placement(B, K, True, rng)
+    matrices = creator.affine_matrices(*placement[1:])
+    timings['placement'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    combined = np.empty((B, size, size, 3), dtype=np.uint8)
+    for bi in range(B):
+        creator.composite(concepts, matrices[bi], bi, out=combined[bi])
+    timings['composite'] = time.perf_counter() - start
+
+    # same chunking as CreateObject.combine
+    images = np.empty_like(combined)
+    step = max(1, creator.chunk_bytes//(4*size*size*3))
+    for chunk_start in range(0, B, step):
+        chunk = slice(chunk_start, chunk_start + step)
+        start = time.perf_counter()
+        work = creator.noise_batch(combined[chunk], rng)
+        t1 = time.perf_counter()
+        creator.normalize_batch(work, background, out=images[chunk])
+        timings['noise'] += t1 - start
+        timings['normalize'] += time.perf_counter() - t1
+
+    for bi, image in enumerate(images):
+        start = time.perf_counter()
+        ok, encoded = cv2.imencode('.png', image)
+        t1 = time.perf_counter()
+        if not ok:
+            raise IOError(f'could not encode image {bi}')
+        with open(os.path.join(save_dir, f'{bi}.png'), 'wb') as f:
+            f.write(encoded.tobytes())
+        t2 = time.perf_counter()
+        timings['encode'] += t1 - start
+        timings['write'] += t2 - t1
+    return timings
+
+
+def run_config(config):
+    # executed in a fresh child process; median stage times over repeats
+    rng = np.random.default_rng(config['seed'])
+    baseline_rss = peak_rss_mb()
+    runs = []
+    with tempfile.TemporaryDirectory() as save_dir:
+        run_stages(dict(config, batch_size=min(config['batch_size'], 2)), rng, save_dir)
+        for _ in range(config['repeat']):
+            runs.append(run_stages(config, rng, save_dir))
+
+    B = config['batch_size']
+    stages = {}
+    for name in STAGES:
+        seconds = float(np.median([run[name] for run in runs]))
+        stages[name] = {'seconds': seconds,
+                        'us_per_image': 1e6*seconds/B}
+    total = sum(stage['seconds'] for stage in stages.values())
+    generate = total - stages['encode']['seconds'] - stages['write']['seconds']
+    return dict(config,
+                stages=stages,
+                images_per_sec=B/total,
+                generate_images_per_sec=B/generate,
+                peak_rss_mb=peak_rss_mb(),
+                baseline_rss_mb=baseline_rss)
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                                            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cv2': cv2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def sweep(sizes, kconcepts, batch_sizes, shapes, repeat=3, seed=0):
+    configs = [{'size': size, 'Kconcepts': K, 'batch_size': B, 'shape': shape,
+                'repeat': repeat, 'seed': seed}
+                for size, K, B, shape in itertools.product(sizes, kconcepts, batch_sizes, shapes)]
+
+    results = []
+    ctx = mp.get_context('fork')
+    for config in configs:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_config, (config,))
+        results.append(result)
+        print(f"size={result['size']:5d} K={result['Kconcepts']} B={result['batch_size']:4d} "
+                f"shape={result['shape']:9s} {result['images_per_sec']:9.1f} img/s "
+                f"peak {result['peak_rss_mb']:7.1f} MB  " +
+                ' '.join(f"{name}={result['stages'][name]['us_per_image']:.0f}us" for name in STAGES),
+                flush=True)
+    return {'environment': environment(), 'results': results}
+
+
+IMPORT_PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start,
+                  'modules': len(sys.modules),
+                  'matplotlib': 'matplotlib' in sys.modules}}))
+'''
+
+
+def import_times(modules, repeat=5):
+    # median cold import time of every module in a new python process
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for module in modules:
+        runs = []
+        for _ in range(repeat):
+            out = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE.format(module=module)], cwd=root)
+            runs.append(json.loads(out))
+        seconds = float(np.median([run['seconds'] for run in runs]))
+        results[module] = dict(runs[-1], seconds=seconds)
+        print(f"import {module:12s} {1e3*seconds:7.1f} ms  {runs[-1]['modules']} modules"
+                f"{'  (matplotlib loaded)' if runs[-1]['matplotlib'] else ''}", flush=True)
+    return results
+
+
+def config_key(result):
+    return (result['size'], result['Kconcepts'], result['batch_size'], result['shape'])
+
+
+def compare(old, new, tolerance=0.1):
+    # configs whose throughput dropped by more than tolerance
+    previous = {config_key(r): r for r in old['results']}
+    regressions = []
+    for result in new['results']:
+        key = config_key(result)
+        if key not in previous:
+            continue
+        ratio = result['images_per_sec']/previous[key]['images_per_sec']
+        print(f'{key}: {ratio:.2f}x')
+        if ratio < 1 - tolerance:
+            regressions.append((key, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='per-stage benchmark of the generation pipeline')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256, 512, 1024])
+    parser.add_argument('--kconcepts', type=int, nargs='+', default=[3, 5])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32])
+    parser.add_argument('--shapes', nargs='+', default=['mixed'],
+                        help="'mixed' or any CreateObject type, e.g. circle square")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--compare', default=None, help='previous results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--imports', nargs='*', default=None,
+                        help='only time cold imports of these modules (default src.utils src.main)')
+    args = parser.parse_args(argv)
+
+    if args.imports is not None:
+        # import timing only, no stage sweep
+        report = {'environment': environment(),
+                    'imports': import_times(args.imports or ['src.utils', 'src.main'], args.repeat)}
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        return 0
+
+    report = sweep(args.sizes, args.kconcepts, args.batch_sizes, args.shapes,
+                    repeat=args.repeat, seed=args.seed)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        if regressions:
+            print('throughput regressions:', regressions)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import os
+import cv2
+import random
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from src.storage import atomic_write
+
+
+# Content-addressed cache of completed datasets. An entry is a folder
+# root/{key} holding the files of one finished save_dir and entry.json with
+# their sizes and sha256 digests; key is the hash of everything that decides
+# the output (see cache_key). Entries are published with a single rename,
+# handed out as hard links (copies across file systems), checked against the
+# recorded sizes (and digests, see verify) before use and evicted least recently used first once the
+# cache grows beyond quota bytes.
+
+ENTRY = 'entry.json'
+VERIFY = ('size', 'sample', 'full')
+
+
+def canonical(value):
+    # json with sorted keys and no whitespace, tuples and int keys normalised
+    return json.dumps(json.loads(json.dumps(value)), sort_keys=True, separators=(',', ':'))
+
+
+def code_version(*modules):
+    # sha256 of the source of the modules producing the data plus the
+    # versions of the libraries rendering it
+    h = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            h.update(f.read())
+    h.update(f'numpy {np.__version__} cv2 {cv2.__version__}'.encode())
+    return h.hexdigest()
+
+
+def cache_key(*parts):
+    return hashlib.sha256(canonical(parts).encode()).hexdigest()
+
+
+def file_digest(path, chunk=2**20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+    # replaces dst atomically with a hard link to src, or a copy of it when
+    # src lives on another file system
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+class DatasetCache(object):
+    def __init__(self, root, quota=None):
+        self.root = root
+        self.quota = quota
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def entry(self, key):
+        # entry.json of a published entry, None if there is none
+        try:
+            with open(os.path.join(self.path(key), ENTRY)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def entries(self):
+        if not os.path.isdir(self.root):
+            return {}
+        entries = {}
+        for key in os.listdir(self.root):
+            entry = self.entry(key)
+            if entry is not None:
+                entries[key] = entry
+        return entries
+
+    def verify(self, key, entry, mode='size', sample=64):
+        # every recorded file present with its size; 'sample' also checks the
+        # digest of sample random files, 'full' of all of them (reads the
+        # whole entry)
+        if mode not in VERIFY:
+            raise ValueError(f'verify must be one of {VERIFY}, got {mode!r}')
+        for name, (size, _) in entry['files'].items():
+            try:
+                if os.path.getsize(os.path.join(self.path(key), name)) != size:
+                    return False
+            except OSError:
+                return False
+        names = list(entry['files'])
+        if mode == 'sample':
+            names = random.sample(names, min(sample, len(names)))
+        elif mode == 'size':
+            names = []
+        for name in names:
+            if file_digest(os.path.join(self.path(key), name)) != entry['files'][name][1]:
+                return False
+        return True
+
+    def fetch(self, key, save_dir, verify='size'):
+        # links the entry's files into save_dir; False if there is no entry
+        # or it failed verification, in which case the entry is dropped
+        entry = self.entry(key)
+        if entry is None:
+            return False
+        if not self.verify(key, entry, verify):
+            self.remove(key)
+            return False
+        for name in entry['files']:
+            link_or_copy(os.path.join(self.path(key), name), os.path.join(save_dir, name))
+        self.touch(key, entry)
+        return True
+
+    def store(self, key, save_dir, config=None, exclude=()):
+        # publishes the files of save_dir (minus the exclude folders and
+        # files) as entry key and evicts old entries down to the quota. An
+        # entry that already exists, e.g. stored by a concurrent job, is kept.
+        # Entries share inodes with save_dir, so the writers of storage.py
+        # never change a hard-linked file in place: they replace it, unlink
+        # it first (unlink_shared) or unshare() it before writing into it
+        if self.entry(key) is not None:
+            return False
+        exclude = {os.path.normpath(os.path.relpath(path, save_dir)) for path in exclude}
+        tmp = os.path.join(self.root, f'.{key}.{os.getpid()}.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(save_dir):
+            rel = os.path.relpath(dirpath, save_dir)
+            dirnames[:] = sorted(d for d in dirnames if os.path.normpath(os.path.join(rel, d)) not in exclude)
+            for filename in sorted(filenames):
+                name = os.path.normpath(os.path.join(rel, filename))
+                if filename.endswith('.tmp') or name in exclude:
+                    continue
+                link_or_copy(os.path.join(dirpath, filename), os.path.join(tmp, name))
+                path = os.path.join(tmp, name)
+                files[name] = [os.path.getsize(path), file_digest(path)]
+        entry = {'key': key,
+                    'config': config,
+                    'files': files,
+                    'bytes': sum(size for size, _ in files.values()),
+                    'created': time.time(),
+                    'used': time.time()}
+        with open(os.path.join(tmp, ENTRY), 'w') as f:
+            json.dump(entry, f, indent=2)
+        try:
+            os.rename(tmp, self.path(key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        self.evict(keep=key)
+        return True
+
+    def touch(self, key, entry):
+        entry['used'] = time.time()
+        atomic_write(os.path.join(self.path(key), ENTRY), lambda f: json.dump(entry, f, indent=2))
+
+    def remove(self, key):
+        # renamed away first so readers never see a half deleted entry
+        trash = os.path.join(self.root, f'.{key}.{os.getpid()}.trash')
+        try:
+            os.rename(self.path(key), trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def size(self):
+        return sum(entry['bytes'] for entry in self.entries().values())
+
+    def evict(self, keep=None):
+        # least recently used entries first until the cache fits the quota;
+        # keep (the entry just stored) is never evicted. Returns the removed keys
+        if self.quota is None:
+            return []
+        entries = self.entries()
+        total = sum(entry['bytes'] for entry in entries.values())
+        removed = []
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]['used']):
+            if total <= self.quota:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= entry['bytes']
+            removed.append(key)
+        return removed
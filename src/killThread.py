@@ -1,6 +1,7 @@
 import sys
-import trace
+import time
 import threading
+import multiprocessing as mp
 
 class KThread(threading.Thread):
   def __init__(self, *args, **keywords):
@@ -31,4 +32,32 @@ class KThread(threading.Thread):
     return self.localtrace
 
   def kill(self):
-    self.killed = True
\ No newline at end of file
+    self.killed = True
+
+# KThread pays a trace callback on every line and cannot stop C calls, so
+# generation jobs use CancelToken instead: workers poll it between batches
+# (no per-line cost) and CreateDataset.create hard-kills its process pool
+# if they do not stop within a grace period.
+class CancelToken(object):
+  def __init__(self, timeout=None):
+    # a fork-context Event is shared with pool workers forked after it;
+    # the deadline uses the system-wide monotonic clock
+    self.event = mp.get_context('fork').Event()
+    self.deadline = None if timeout is None else time.monotonic() + timeout
+
+  def cancel(self):
+    self.event.set()
+
+  @property
+  def cancelled(self):
+    if self.deadline is not None and time.monotonic() >= self.deadline:
+      return True
+    return self.event.is_set()
+
+  def limit(self, timeout):
+    # cancel timeout seconds from now at the latest, an earlier deadline stays
+    if timeout is None:
+      return
+    deadline = time.monotonic() + timeout
+    if self.deadline is None or deadline < self.deadline:
+      self.deadline = deadline
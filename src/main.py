@@ -1,60 +1,841 @@
-import cv2
 import os
+import cv2
+import sys
+import copy
+import json
+import time
+import difflib
+import argparse
+import resource
 import numpy as np
-import matplotlib.pyplot as plt 
-from src.utils import CreateObject
+import multiprocessing as mp
+from queue import Empty
+from collections import OrderedDict, deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import src.utils
+import src.stats
+import src.storage
+from src.utils import CreateObject, concat_annotations
+from src.storage import WRITERS, AnnotationWriter, AsyncWriter, InstrumentedWriter, Manifest, PyramidWriter, \
+                        merge_shards, sample_index
+from src.metrics import Metrics, Reporter, LogSink, JSONLinesSink, PrometheusSink
+from src.stats import Stats
+from src.visualize import save_montage
+from src.killThread import CancelToken
+from src.ring import RingBuffer, RingProducer
+from src.cache import VERIFY, DatasetCache, cache_key, code_version
 
 
 class CreateDataset(object):
-    def __init__(self, 
-                    N= 10000, 
+    def __init__(self,
+                    N= 10000,
                     batch_size=32,
                     height=128,
                     width=128,
-                    Kconcepts=5, 
+                    Kconcepts=5,
                     nclasses=3,
-                    classes={1: ['circe', 'capsule', 'ellipse'],
+                    classes={1: ['circle', 'capsule', 'ellipse'],
                                 2: ['square', 'pentagon', 'triangle']},
-                    save_dir='../../data'):
+                    save_dir='../../data',
+                    seed=None,
+                    workers=1,
+                    backend='png',
+                    shard_size=4096,
+                    writer_threads=4,
+                    resume=False,
+                    sprite_bank=None,
+                    bank_dir=None,
+                    annotations=False,
+                    shard_id=0,
+                    num_shards=1,
+                    max_memory=None,
+                    pyramid=None,
+                    sinks=None,
+                    metrics_interval=10.0,
+                    cache_dir=None,
+                    cache_quota=None,
+                    bank_seed=0,
+                    cache_verify='size'):
         self.Ndatapoints = N
         self.batch_size = batch_size
         self.Kconcepts=Kconcepts
         self.class_rules = classes
+        self.nclasses = nclasses
         self.height = height
         self.width = width
+        # with num_shards > 1 this process owns only batch_range of the
+        # dataset and writes it, manifest and stats included, to its own
+        # save_dir/shard-{id}-of-{n} folder; merge_shards(save_dir) joins them
+        self.root_dir = save_dir
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        if not 0 <= shard_id < num_shards:
+            raise ValueError(f'shard_id {shard_id} out of range for {num_shards} shards')
+        if num_shards > 1:
+            save_dir = os.path.join(save_dir, f'shard-{shard_id:05d}-of-{num_shards:05d}')
         self.save_dir = save_dir
+        self.workers = workers
+        self.backend = backend
+        self.resume = resume
+        self.manifest = Manifest(save_dir)
+        self.completed = set()
+        self.cancel_token = None
+
+        # master seed, every batch derives its own stream from (seed, ibatch)
+        # so the output does not depend on the number of workers; a resumed
+        # run without an explicit seed continues with the recorded one
+        if seed is None and resume:
+            config, _ = self.manifest.load()
+            seed = None if config is None else config['seed']
+        if seed is None and num_shards > 1:
+            raise ValueError(f'seed is required with num_shards={num_shards}, every shard must draw from the same streams')
+        if seed is None:
+            seed = int(np.random.SeedSequence().generate_state(1)[0])
+        self.seed = seed
 
-        os.makedirs(self.save_dir, exist_ok=True)
-        for i in range(nclasses):
-            os.makedirs(os.path.join(self.save_dir, f'class-{i}'), exist_ok=True)
+        # stage timers and counters of this process, reported to the sinks
+        # (metrics.LogSink, JSONLinesSink, PrometheusSink) every
+        # metrics_interval seconds during create()
+        self.metrics = Metrics()
+        self.reporter = Reporter(sinks or [], metrics_interval)
+        self.metrics_interval = metrics_interval
+        self.metrics_queue = None
+        self.published = time.monotonic()
 
         self.object_creator = CreateObject(self.height, self.width)
+        self.object_creator.metrics = self.metrics
+        self.concept_names = list(self.object_creator.objects.keys())
+
+        # class rules compiled to concept id pools, checked before anything
+        # is drawn; the per-batch concept lists come from concept_plan
+        self.rule_ids = self.compile_rules(classes)
+        self.plan_blocks = OrderedDict()
+
+        # sprite_bank: number of pre-rendered variants per concept type, images
+        # are assembled from the bank instead of being rasterized per sample.
+        # The bank is drawn from bank_seed, not the master seed, so runs with
+        # different (or random) seeds share the bank cached in bank_dir
+        # (default save_dir/sprite-bank)
+        self.sprite_bank = sprite_bank
+        self.bank_seed = bank_seed
+        self.bank_dir = None
+        if sprite_bank is not None:
+            self.bank_dir = os.path.join(self.root_dir, 'sprite-bank') if bank_dir is None else bank_dir
+            self.object_creator.load_bank(sprite_bank, self.bank_dir, bank_seed)
+
+        # 'png': class-{i}/{idx}.png files, 'npy': memory-mappable shards
+        self.shard_size = shard_size
+        self.writer = self.make_writer(self)
+
+        # pyramid: smaller sizes written in the same pass to
+        # save_dir/{height}x{width}, area-downsampled from the full render so
+        # every scale shows the same samples. A size is (height, width) or
+        # an int, the longer side of a level with the canvas aspect ratio
+        self.pyramid = sorted({self.level_size(s) if isinstance(s, int) else tuple(s) for s in pyramid or []},
+                                key=lambda size: (size[0]*size[1], size), reverse=True)
+        self.pyramid = [size for size in self.pyramid if size != (height, width)]
+        if self.pyramid:
+            for h, w in self.pyramid:
+                if h > height or w > width:
+                    raise ValueError(f'pyramid size {h}x{w} is larger than the rendered {height}x{width}')
+            self.writer = PyramidWriter(self.writer, [(h, w, self.make_writer(self.scaled(h, w)))
+                                                        for h, w in self.pyramid])
+        self.writer = InstrumentedWriter(self.writer, self.metrics)
+        if writer_threads > 0:
+            self.writer = AsyncWriter(self.writer, writer_threads, metrics=self.metrics)
+
+        # annotations=True also stores per-object masks, boxes, concept types
+        # and translate slots in save_dir/annotations
+        self.annotations = annotations
+        self.annotation_writer = AnnotationWriter(self) if annotations else None
+
+        # max_memory (bytes, shared by all workers) caps the estimated peak
+        # of every process: class batches are rendered and written in
+        # sub-batches of self.sub_batch samples, which leaves the output as is
+        self.max_memory = max_memory
+        self.memory_plan = self.plan_memory(max_memory)
+        self.sub_batch = self.memory_plan['sub_batch']
+
+        # cache_dir: completed datasets keyed by cache_key(), a create() of an
+        # identical configuration links the cached files into save_dir
+        # instead of generating. cache_quota (bytes) bounds the cache, least
+        # recently used datasets are evicted first. cache_verify checks a hit
+        # by file sizes ('size'), plus the sha256 of a random sample of files
+        # ('sample') or of every file ('full', reads the whole dataset)
+        if cache_verify not in VERIFY:
+            raise ValueError(f'cache_verify must be one of {VERIFY}, got {cache_verify!r}')
+        self.cache = None if cache_dir is None else DatasetCache(cache_dir, cache_quota)
+        self.cache_verify = cache_verify
+        self.cached = False
+
+    def make_writer(self, dataset):
+        if self.backend == 'npy':
+            return WRITERS[self.backend](dataset, shard_size=self.shard_size)
+        return WRITERS[self.backend](dataset)
+
+    def level_size(self, side):
+        # (height, width) of the canvas aspect ratio with longer side `side`
+        scale = side/max(self.height, self.width)
+        return max(1, round(self.height*scale)), max(1, round(self.width*scale))
+
+    def scaled(self, height, width):
+        # shallow copy describing the height x width level of the pyramid
+        view = copy.copy(self)
+        view.height, view.width = height, width
+        view.save_dir = os.path.join(self.save_dir, f'{height}x{width}')
+        return view
+
+    @property
+    def nbatches(self):
+        return self.Ndatapoints//self.batch_size
+
+    @property
+    def batch_range(self):
+        # [start, stop) global batches of this shard, contiguous and fixed by
+        # (nbatches, shard_id, num_shards) alone
+        return (self.nbatches*self.shard_id//self.num_shards,
+                self.nbatches*(self.shard_id + 1)//self.num_shards)
+
+    def config(self):
+        config = {'N': self.Ndatapoints,
+                    'batch_size': self.batch_size,
+                    'height': self.height,
+                    'width': self.width,
+                    'Kconcepts': self.Kconcepts,
+                    'nclasses': self.nclasses,
+                    'classes': self.class_rules,
+                    'seed': self.seed,
+                    'backend': self.backend,
+                    'sprite_bank': self.sprite_bank,
+                    'bank_seed': None if self.sprite_bank is None else self.bank_seed,
+                    'annotations': self.annotations,
+                    'shard_id': self.shard_id,
+                    'num_shards': self.num_shards,
+                    'batch_range': list(self.batch_range),
+                    'pyramid': [list(size) for size in self.pyramid],
+                    'concept_plan': 'balanced-v2'}
+        if self.backend == 'npy':
+            # the shard layout of the npy files
+            config['shard_size'] = self.shard_size
+        return json.loads(json.dumps(config))
+
+    def cache_key(self):
+        # the manifest config (seed and npy shard_size included), the
+        # CreateObject parameters and the code writing the images, manifest
+        # and statistics; workers, threads and memory budget leave the output
+        # unchanged and are not part of it
+        return cache_key(self.config(), self.object_creator.params(),
+                            code_version(src.utils, src.stats, src.storage, sys.modules[__name__]))
+
+    def cache_excludes(self):
+        # a sprite bank, the cache itself or metrics files inside save_dir
+        # are not part of the dataset
+        sinks = [getattr(sink, 'path', None) for sink in self.reporter.sinks]
+        return [path for path in [self.bank_dir, self.cache.root] + sinks if path is not None]
+
+    def sample_index(self, ibatch, class_, i=0):
+        return sample_index(ibatch, class_, self.nclasses, self.batch_size) + i
+
+    def locate(self, index):
+        # (ibatch, class_, i) of a global sample index
+        ibatch, i = divmod(index, self.nclasses*self.batch_size)
+        class_, i = divmod(i, self.batch_size)
+        return ibatch, class_, i
+
+    def derive_seed(self, *key):
+        return int(np.random.SeedSequence(self.seed, spawn_key=key).generate_state(1, np.uint64)[0])
+
+    def batch_seed(self, ibatch):
+        # batch level draws: background and class concept lists
+        return self.derive_seed(0, ibatch)
+
+    def sample_seed(self, index):
+        # everything drawn for one image: shapes, colours, placement, noise
+        return self.derive_seed(1, index)
+
+    def compile_rules(self, rules):
+        # {rule: concept id array}. Class 0 mixes rule 1 (2 to Kconcepts - 1
+        # objects) with rule 2, every class c > 0 draws from rule c
+        rules = {int(k): v for k, v in rules.items()}
+        required = set(range(1, max(self.nclasses, 3)))
+        if set(rules) != required:
+            raise ValueError(f'classes needs rules for {sorted(required)} with nclasses={self.nclasses}, got {sorted(rules)}')
+        if self.Kconcepts < 3:
+            raise ValueError(f'Kconcepts={self.Kconcepts}, class 0 needs at least 2 objects of rule 1 and one of rule 2')
+        slots = len(self.object_creator.translate)
+        if self.Kconcepts > slots:
+            raise ValueError(f'Kconcepts={self.Kconcepts}, every object needs one of the {slots} translate slots')
+        rule_ids = {}
+        for rule, names in sorted(rules.items()):
+            unknown = [name for name in names if name not in self.concept_names]
+            if not names or unknown:
+                hints = {name: difflib.get_close_matches(name, self.concept_names, 1) for name in unknown}
+                raise ValueError(f'rule {rule} has unknown concepts {hints or names}, allowed: {self.concept_names}')
+            rule_ids[rule] = np.array([self.concept_names.index(name) for name in names], dtype=np.uint8)
+        return rule_ids
+
+    # batches per concept plan block, fixed so that a plan never depends on
+    # N and random access only draws the block it needs; the last
+    # plan_cache blocks used are kept
+    plan_block_size = 1024
+    plan_cache = 4
+
+    def concept_plan(self, block):
+        # (plan_block_size, nclasses, Kconcepts) concept ids of the batches
+        # block*plan_block_size, ... drawn in one go from derive_seed(4, block).
+        # Every rule's slots of a class are filled from a shuffled, exactly
+        # balanced sequence of its concepts, so within a block concept counts
+        # differ by at most one
+        if block in self.plan_blocks:
+            self.plan_blocks.move_to_end(block)
+            return self.plan_blocks[block]
+
+        rng = np.random.default_rng(self.derive_seed(4, block))
+        n, K = self.plan_block_size, self.Kconcepts
+
+        def balanced(ids, size):
+            return ids[rng.permutation(np.arange(size) % len(ids))]
+
+        plan = np.empty((n, self.nclasses, K), dtype=np.uint8)
+        first = rng.integers(2, K, n)
+        mixed = np.arange(K)[None] < first[:, None]
+        plan[:, 0][mixed] = balanced(self.rule_ids[1], int(mixed.sum()))
+        plan[:, 0][~mixed] = balanced(self.rule_ids[2], int((~mixed).sum()))
+        for class_ in range(1, self.nclasses):
+            plan[:, class_] = balanced(self.rule_ids[class_], n*K).reshape(n, K)
+
+        self.plan_blocks[block] = plan
+        while len(self.plan_blocks) > self.plan_cache:
+            self.plan_blocks.popitem(last=False)
+        return plan
+
+    def sample_objects(self, ibatch):
+        # {class: concept names} of batch ibatch from the concept plan
+        block, i = divmod(ibatch, self.plan_block_size)
+        ids = self.concept_plan(block)[i]
+        return {class_: [self.concept_names[c] for c in ids[class_]] for class_ in range(self.nclasses)}
+
+    def batch_plan(self, ibatch):
+        rng = np.random.default_rng(self.batch_seed(ibatch))
+        background = tuple([int(a) for a in rng.integers(50, 255, 3)])
+        classes = self.sample_objects(ibatch)
+        return background, classes
+
+    def render(self, ibatch, class_, offsets, plan=None, annotate=False):
+        # images of samples (ibatch, class_, i) for i in offsets, every one
+        # from its own sample_seed so any subset renders identically;
+        # annotate=True returns (images, annotations) like combine
+        background, classes = self.batch_plan(ibatch) if plan is None else plan
+        rngs = [np.random.default_rng(self.sample_seed(self.sample_index(ibatch, class_, i)))
+                    for i in offsets]
+        if self.sprite_bank is not None:
+            return self.object_creator.combine_bank(classes[class_], background=background,
+                                                    rng=rngs, annotate=annotate)
+        objects = []
+        for type_ in classes[class_]:
+            with self.metrics.timer(f'concept.{type_}'):
+                objects.append(self.object_creator.sample_sprites(type=type_, rng=rngs))
+        return self.object_creator.combine(objects, background=background, transform=True,
+                                            rng=rngs, annotate=annotate)
+
+    def render_chunks(self, ibatch, class_, plan, annotate=False):
+        # (offset, images, annotations) of the class batch in sub-batches
+        for offset in range(0, self.batch_size, self.sub_batch):
+            offsets = range(offset, min(offset + self.sub_batch, self.batch_size))
+            rendered = self.render(ibatch, class_, offsets, plan, annotate)
+            yield (offset, *rendered) if annotate else (offset, rendered, None)
+
+    def estimate_memory(self, n):
+        # estimated peak bytes per stage of rendering and writing n samples
+        # of one class batch in a process
+        creator = self.object_creator
+        y0, y1, x0, x1 = creator.window
+        window = (y1 - y0)*(x1 - x0)
+        image = self.height*self.width*3
+        chunk = min(n, max(1, creator.chunk_bytes//(4*image)))
+        depth = self.writer.depth if isinstance(self.writer, AsyncWriter) else 0
+        stages = {'baseline': peak_rss(),
+                    'sprites': 0 if self.sprite_bank is not None else n*self.Kconcepts*window*4,
+                    'rasterize': 0 if self.sprite_bank is not None else n*window*3,
+                    'composite': n*image,
+                    'postprocess': chunk*self.height*self.width*(4*3 + 4 + 3),
+                    'output': n*image,
+                    'pyramid': max(depth, 1)*n*sum(h*w*3 for h, w in self.pyramid),
+                    'writer': depth*n*image}
+        return stages
+
+    def plan_memory(self, max_memory=None):
+        # largest sub-batch whose estimate fits max_memory/workers
+        stages = self.estimate_memory(self.batch_size)
+        plan = {'max_memory': max_memory, 'sub_batch': self.batch_size,
+                'estimate': sum(stages.values()), 'stages': stages}
+        if max_memory is None:
+            return plan
+
+        budget = max_memory//max(self.workers, 1)
+        for n in range(self.batch_size, 0, -1):
+            stages = self.estimate_memory(n)
+            if sum(stages.values()) <= budget:
+                return dict(plan, sub_batch=n, estimate=sum(stages.values()), stages=stages)
+        raise ValueError(f'max_memory of {max_memory/2**20:.0f}MB for {max(self.workers, 1)} workers is below '
+                            f'the estimated {sum(stages.values())/2**20:.0f}MB of one sample per worker', stages)
+
+    def save_images(self, images, class_, start_idx=0, concepts=None, offset=0):
+        self.writer.write(start_idx, class_, concepts, images, offset)
+
+
+    def generate_batch(self, ibatch):
+        # [(class, concepts, images), ...] for every class of batch ibatch
+        plan = self.batch_plan(ibatch)
+        batch = []
+        for key, concepts in plan[1].items():
+            images = np.empty((self.batch_size, self.height, self.width, 3), dtype=np.uint8)
+            for offset, chunk, _ in self.render_chunks(ibatch, key, plan):
+                images[offset:offset + len(chunk)] = chunk
+            batch.append((key, concepts, images))
+        return batch
+
+    def generate_arrays(self, ibatch):
+        # batch ibatch as shuffled (images, labels, concepts) uint8 arrays,
+        # concepts index into self.concept_names
+        batch = self.generate_batch(ibatch)
+        images = np.concatenate([images for _, _, images in batch])
+        labels = np.concatenate([np.full(len(images), key, dtype=np.uint8) for key, _, images in batch])
+        concepts = np.concatenate([np.tile([self.concept_names.index(c) for c in concepts], (len(images), 1))
+                                    for _, concepts, images in batch]).astype(np.uint8)
+
+        order = np.random.default_rng(self.derive_seed(2, ibatch)).permutation(len(images))
+        return images[order], labels[order], concepts[order]
+
+    def get(self, index):
+        images, labels, concepts = self.get_batch([index])
+        return images[0], labels[0], concepts[0]
+
+    def get_batch(self, indices):
+        # regenerate (images, labels, concepts) of arbitrary global indices,
+        # identical to what create()/stream() produce for them
+        images = np.empty((len(indices), self.height, self.width, 3), dtype=np.uint8)
+        labels = np.empty(len(indices), dtype=np.uint8)
+        concepts = np.empty((len(indices), self.Kconcepts), dtype=np.uint8)
+
+        groups = {}
+        for j, index in enumerate(indices):
+            if index < 0:
+                raise IndexError(index)
+            ibatch, class_, i = self.locate(int(index))
+            groups.setdefault((ibatch, class_), []).append((j, i))
+
+        plans = {}
+        for (ibatch, class_), items in groups.items():
+            if ibatch not in plans:
+                plans[ibatch] = self.batch_plan(ibatch)
+            positions = [j for j, _ in items]
+            images[positions] = self.render(ibatch, class_, [i for _, i in items], plans[ibatch])
+            labels[positions] = class_
+            concepts[positions] = [self.concept_names.index(c) for c in plans[ibatch][1][class_]]
+        return images, labels, concepts
+
+    def preview(self, path=None, indices=None, ncols=None, scale=1):
+        # montage of the given samples (default: the first batch, one row
+        # per class) labelled by class, regenerated with get_batch and
+        # written to path (default save_dir/preview.png)
+        if indices is None:
+            indices = range(self.sample_index(0, 0), self.sample_index(0, self.nclasses))
+            ncols = self.batch_size if ncols is None else ncols
+        path = os.path.join(self.save_dir, 'preview.png') if path is None else path
+        images, labels, _ = self.get_batch(list(indices))
+        return save_montage(path, images, ncols=ncols, labels=[str(c) for c in labels], scale=scale)
+
+    def create_batch(self, ibatch):
+        if ibatch in self.completed:
+            return ibatch
+
+        record = {'batch': ibatch,
+                    'seed': self.batch_seed(ibatch),
+                    'start': self.sample_index(ibatch, 0),
+                    'count': 0,
+                    'classes': {}}
+        stats = Stats()
+        plan = self.batch_plan(ibatch)
+        for key, concepts in plan[1].items():
+            # one annotation file per class batch whatever the sub-batching,
+            # so reruns under another memory budget replace it
+            parts = []
+            for offset, images, annotations in self.render_chunks(ibatch, key, plan, self.annotations):
+                self.save_images(images, key, ibatch, concepts, offset)
+                if annotations is not None:
+                    parts.append((offset, annotations))
+                with self.metrics.timer('stats'):
+                    stats.update(key, images, concepts)
+                self.metrics.add('images', len(images))
+                record['count'] += len(images)
+            if parts:
+                with self.metrics.timer('annotations'):
+                    self.annotation_writer.write(ibatch, key, concat_annotations(parts))
+            record['classes'][str(key)] = [str(c) for c in concepts]
+        record['stats'] = stats.to_dict()
+
+        # logged only once every image of the batch has been written
+        self.writer.barrier(partial(self.manifest.append, record))
+        self.metrics.add('batches')
+        return ibatch
+
+    def create_range(self, start, stop):
+        done = []
+        for ibatch in range(start, stop):
+            if self.cancel_token is not None and self.cancel_token.cancelled:
+                break
+            done.append(self.create_batch(ibatch))
+            self.publish()
+        self.writer.flush()
+        self.publish(force=True)
+        return done
+
+    def publish(self, force=False):
+        # hand the metrics snapshot to the reporter, or from a pool worker to
+        # the parent's, at most once per metrics_interval
+        now = time.monotonic()
+        if not force and now - self.published < self.metrics_interval:
+            return
+        self.published = now
+        if self.metrics_queue is not None:
+            self.metrics_queue.put(self.metrics.snapshot())
+        else:
+            self.reporter.update(self.metrics.snapshot())
+            self.reporter.tick(force)
+
+    def drain_metrics(self, queue):
+        # never blocks: workers put through the queue's feeder thread, so
+        # this must keep running while they finish
+        while True:
+            try:
+                self.reporter.update(queue.get_nowait())
+            except Empty:
+                break
+        self.reporter.tick()
+
+    def shards(self, nshards):
+        # contiguous ranges of batch_range, a few per worker so slow shards
+        # get balanced out
+        bounds = np.linspace(*self.batch_range, nshards + 1).astype(int)
+        return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def load_completed(self):
+        # batches a previous run with the same config already finished
+        self.manifest.repair()
+        config, records = self.manifest.load()
+        if config is None or not records:
+            return set()
+        if config != self.config():
+            raise ValueError('save_dir holds a different dataset: ', config)
+        return set(records)
+
+    def stats(self):
+        # Stats merged over every batch recorded in the manifest
+        _, records = self.manifest.load()
+        stats = Stats()
+        for record in records.values():
+            stats.merge(Stats.from_dict(record.get('stats', {})))
+        return stats
+
+    def report(self):
+        # completed batches according to the manifest, statistics of those
+        # batches are written to save_dir/stats.json
+        _, records = self.manifest.load()
+        completed = sorted(records)
+        self.stats().save(os.path.join(self.save_dir, 'stats.json'))
+        cancelled = self.cancel_token is not None and self.cancel_token.cancelled
+        return {'completed': completed,
+                'cached': self.cached,
+                'cancelled': cancelled and len(completed) < self.batch_range[1] - self.batch_range[0],
+                'memory': {'sub_batch': self.sub_batch,
+                            'estimate_mb': self.memory_plan['estimate']/2**20,
+                            'peak_rss_mb': peak_rss()/2**20,
+                            'peak_worker_rss_mb': peak_rss(resource.RUSAGE_CHILDREN)/2**20}}
+
+    def create(self, cancel=None, timeout=None, grace=5.0):
+        # cancel is a CancelToken checked between batches and timeout (seconds)
+        # cancels the run. Pool workers still busy grace seconds after the
+        # cancellation are killed; only fully written batches are reported.
+        self.cancel_token = CancelToken() if cancel is None else cancel
+        self.cancel_token.limit(timeout)
+
+        self.reporter.start = time.time()
+        if self.cache is not None:
+            # on a hit save_dir shares the entry's files through hard links
+            self.cached = self.cache.fetch(self.cache_key(), self.save_dir, self.cache_verify)
+            if self.cached:
+                return self.report()
+        # checked before the writers open, which may recreate files of a
+        # mismatching dataset
+        self.completed = self.load_completed() if self.resume else set()
+        self.writer.open()
+        if self.annotation_writer is not None:
+            self.annotation_writer.open()
+        if not self.completed:
+            self.manifest.reset(self.config())
+            if self.annotation_writer is not None:
+                self.annotation_writer.clear()
+        if self.workers <= 1:
+            self.create_range(*self.batch_range)
+            self.writer.close()
+            return self.store_cached(self.report())
+
+        # drawn once here so forked workers inherit the first plan block
+        self.concept_plan(self.batch_range[0]//self.plan_block_size)
+        shards = self.shards(4*self.workers)
+        # periodic worker snapshots; the final one of every shard comes
+        # back with its result, as a queue write may be lost to terminate()
+        queue = mp.get_context('fork').Queue()
+        with mp.get_context('fork').Pool(self.workers,
+                                        initializer=_init_worker,
+                                        initargs=(self, queue)) as pool:
+            result = pool.map_async(_run_shard, shards)
+            while not result.ready() and not self.cancel_token.cancelled:
+                result.wait(0.1)
+                self.drain_metrics(queue)
+            if not result.ready():
+                self.cancel_token.cancel()
+                deadline = time.monotonic() + grace
+                while not result.ready() and time.monotonic() < deadline:
+                    result.wait(0.1)
+                    self.drain_metrics(queue)
+            if result.ready():
+                for _, snapshot in result.get():
+                    self.reporter.update(snapshot)
+            else:
+                pool.terminate()
+        self.writer.close()
+        self.reporter.tick(force=True)
+        return self.store_cached(self.report())
+
+    def store_cached(self, report):
+        # a complete run becomes the cache entry of its configuration
+        if self.cache is not None and len(report['completed']) == self.batch_range[1] - self.batch_range[0]:
+            self.cache.store(self.cache_key(), self.save_dir, self.config(), exclude=self.cache_excludes())
+        return report
+
+    def serve(self, name, nslots=8, producers=1, start=0, stop=None, cancel=None, timeout=None):
+        # generator service: producers forked processes write generate_arrays
+        # batches start, start+1, ... (until stop, or until cancelled) into
+        # the shared memory ring `name`, where any local process can read
+        # them with RingConsumer(RingBuffer.attach(name), consumer_id).
+        # Blocks until the producers are done; returns the batches produced
+        self.cancel_token = CancelToken() if cancel is None else cancel
+        self.cancel_token.limit(timeout)
+        self.concept_plan(start//self.plan_block_size)
+        ring = RingBuffer.create(name, nslots, self.nclasses*self.batch_size,
+                                    self.height, self.width, self.Kconcepts,
+                                    max_producers=max(producers, 16))
+        ring.set_stop(None if stop is None else stop - start)
+        ctx = mp.get_context('fork')
+        processes = [ctx.Process(target=_produce, args=(self, ring, p, producers, start, stop), daemon=True)
+                        for p in range(producers)]
+        try:
+            for process in processes:
+                process.start()
+            while any(process.is_alive() for process in processes) and not self.cancel_token.cancelled:
+                time.sleep(0.1)
+        finally:
+            ring.shutdown()
+            for process in processes:
+                process.join(5.0)
+                if process.is_alive():
+                    process.terminate()
+            produced = ring.produced
+            ring.close()
+        return produced
+
+    def stream(self, batch_size=None, prefetch=4, start=0, stop=None, drop_last=False):
+        # yields (images, labels, concepts) without touching the disk; batches
+        # start, start+1, ... (forever if stop is None) are generated ahead by
+        # background workers, at most prefetch at a time. batch_size regroups
+        # the nclasses*self.batch_size images of every generated batch; the
+        # remainder at stop comes as a smaller last batch unless drop_last
+        if self.workers <= 1:
+            executor = ThreadPoolExecutor(1)
+            generate = self.generate_arrays
+        else:
+            self.concept_plan(start//self.plan_block_size)
+            executor = ProcessPoolExecutor(self.workers,
+                                            mp_context=mp.get_context('fork'),
+                                            initializer=_init_worker,
+                                            initargs=(self,))
+            generate = _generate_arrays
+
+        ibatch = start
+        pending = deque()
+        buffer = []
+        try:
+            while True:
+                while len(pending) < prefetch and (stop is None or ibatch < stop):
+                    pending.append(executor.submit(generate, ibatch))
+                    ibatch += 1
+                if not pending:
+                    break
+
+                arrays = pending.popleft().result()
+                if batch_size is None:
+                    yield arrays
+                    continue
+
+                buffer.append(arrays)
+                while sum(len(a[0]) for a in buffer) >= batch_size:
+                    merged = [np.concatenate(a) for a in zip(*buffer)]
+                    yield tuple(a[:batch_size] for a in merged)
+                    buffer = [tuple(a[batch_size:] for a in merged)]
+            if buffer and len(buffer[0][0]) and not drop_last:
+                yield tuple(np.concatenate(a) for a in zip(*buffer))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    # peak resident bytes of this process (or of its largest finished child)
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss*scale
+
+
+def _produce(dataset, ring, producer_id, nproducers, start, stop):
+    # producer process of serve(): ring batch n is dataset batch start + n
+    cv2.setNumThreads(1)
+    producer = RingProducer(ring, producer_id)
+    n = producer_id
+    while (stop is None or start + n < stop) and not ring.closed:
+        if not producer.write(n, *dataset.generate_arrays(start + n)):
+            break
+        n += nproducers
+
+
+_worker_dataset = None
+
+def _init_worker(dataset, metrics_queue=None):
+    global _worker_dataset
+    # one process per core, keep cv2 from spawning its own threads on top
+    cv2.setNumThreads(1)
+    _worker_dataset = dataset
+    # fresh counters, sent to the parent's reporter through metrics_queue
+    dataset.metrics.reset()
+    dataset.metrics_queue = metrics_queue
+
+def _run_shard(shard):
+    done = _worker_dataset.create_range(*shard)
+    return done, _worker_dataset.metrics.snapshot()
+
+def _generate_arrays(ibatch):
+    return _worker_dataset.generate_arrays(ibatch)
+
+
+def main(argv=None):
+    # python -m src.main generate --save-dir out --seed 1 --shard-id 0 --num-shards 4
+    # python -m src.main merge out
+    # python -m src.main serve --name ring0 --seed 1 --producers 2
+    parser = argparse.ArgumentParser(description='generate a concept dataset, whole or as one of several shards')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--N', type=int, default=10000)
+    common.add_argument('--batch-size', type=int, default=32)
+    common.add_argument('--height', type=int, default=128)
+    common.add_argument('--width', type=int, default=128)
+    common.add_argument('--kconcepts', type=int, default=5)
+    common.add_argument('--classes', type=json.loads, default=None,
+                        help='json rules, e.g. \'{"1": ["circle"], "2": ["square"]}\'')
+    common.add_argument('--seed', type=int, default=None,
+                        help='master seed, required with --num-shards > 1 so shards agree')
+    common.add_argument('--sprite-bank', type=int, default=None)
+    common.add_argument('--bank-dir', default=None)
+    common.add_argument('--bank-seed', type=int, default=0,
+                        help='seed of the sprite bank, kept apart from --seed so the cached bank is shared')
+
+    generate = commands.add_parser('generate', parents=[common], help='generate the batches of one shard')
+    generate.add_argument('--save-dir', required=True)
+    generate.add_argument('--shard-id', type=int, default=0)
+    generate.add_argument('--num-shards', type=int, default=1)
+    generate.add_argument('--workers', type=int, default=1)
+    generate.add_argument('--backend', choices=sorted(WRITERS), default='png')
+    generate.add_argument('--shard-size', type=int, default=4096)
+    generate.add_argument('--writer-threads', type=int, default=4)
+    generate.add_argument('--annotations', action='store_true')
+    generate.add_argument('--resume', action='store_true')
+    generate.add_argument('--timeout', type=float, default=None)
+    generate.add_argument('--pyramid', type=int, nargs='*', default=None,
+                            help='also write levels of these longer sides (canvas aspect ratio), downsampled from the same render')
+    generate.add_argument('--metrics-log', action='store_true', help='periodic progress line on stderr')
+    generate.add_argument('--metrics-jsonl', default=None, help='append metrics reports to this file')
+    generate.add_argument('--metrics-prom', default=None, help='prometheus textfile with the latest metrics')
+    generate.add_argument('--metrics-interval', type=float, default=10.0)
+    generate.add_argument('--max-memory', type=float, default=None,
+                            help='memory budget in MB shared by all workers, work is sub-batched to fit')
+    generate.add_argument('--preview', action='store_true', help='also write preview.png of the shard')
+    generate.add_argument('--cache-dir', default=None,
+                            help='reuse datasets of identical configurations from this cache')
+    generate.add_argument('--cache-quota', type=float, default=None,
+                            help='cache size in MB, least recently used datasets are evicted beyond it')
+    generate.add_argument('--cache-verify', choices=['size', 'sample', 'full'], default='size',
+                            help='check of a cache hit: file sizes, or also sha256 of a sample or of all files')
+
+    merge = commands.add_parser('merge', help='join shard manifests and statistics into one index')
+    merge.add_argument('save_dir')
+
+    serve = commands.add_parser('serve', parents=[common], help='stream batches into a shared memory ring')
+    serve.add_argument('--name', required=True, help='shared memory name consumers attach to')
+    serve.add_argument('--save-dir', default='.', help='only used for the sprite bank cache')
+    serve.add_argument('--nslots', type=int, default=8)
+    serve.add_argument('--producers', type=int, default=1)
+    serve.add_argument('--start', type=int, default=0)
+    serve.add_argument('--stop', type=int, default=None)
+    serve.add_argument('--timeout', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == 'merge':
+        index = merge_shards(args.save_dir)
+        print(json.dumps({k: index[k] for k in ('nshards', 'completed', 'missing')}))
+        return 0 if not index['missing'] else 1
+
+    kwargs = {}
+    if args.classes is not None:
+        kwargs['classes'] = {int(k): v for k, v in args.classes.items()}
+    if args.command == 'serve':
+        dataset = CreateDataset(N=args.N, batch_size=args.batch_size, height=args.height, width=args.width,
+                                Kconcepts=args.kconcepts, save_dir=args.save_dir, seed=args.seed,
+                                sprite_bank=args.sprite_bank, bank_dir=args.bank_dir, bank_seed=args.bank_seed,
+                                **kwargs)
+        served = dataset.serve(args.name, nslots=args.nslots, producers=args.producers,
+                                start=args.start, stop=args.stop, timeout=args.timeout)
+        print(json.dumps({'name': args.name, 'seed': dataset.seed, 'completed': served}))
+        return 0
+
+    if args.num_shards > 1 and args.seed is None:
+        parser.error('--seed is required with --num-shards > 1')
+    sinks = ([LogSink()] if args.metrics_log else []) + \
+            ([JSONLinesSink(args.metrics_jsonl)] if args.metrics_jsonl else []) + \
+            ([PrometheusSink(args.metrics_prom)] if args.metrics_prom else [])
+    dataset = CreateDataset(N=args.N, batch_size=args.batch_size, height=args.height, width=args.width,
+                            Kconcepts=args.kconcepts, save_dir=args.save_dir, seed=args.seed,
+                            workers=args.workers, backend=args.backend, shard_size=args.shard_size,
+                            writer_threads=args.writer_threads, resume=args.resume,
+                            sprite_bank=args.sprite_bank, bank_dir=args.bank_dir, bank_seed=args.bank_seed,
+                            annotations=args.annotations, shard_id=args.shard_id,
+                            num_shards=args.num_shards,
+                            max_memory=None if args.max_memory is None else int(args.max_memory*2**20),
+                            pyramid=args.pyramid,
+                            sinks=sinks, metrics_interval=args.metrics_interval,
+                            cache_dir=args.cache_dir,
+                            cache_quota=None if args.cache_quota is None else int(args.cache_quota*2**20),
+                            cache_verify=args.cache_verify,
+                            **kwargs)
+    report = dataset.create(timeout=args.timeout)
+    if args.preview:
+        start = dataset.sample_index(dataset.batch_range[0], 0)
+        dataset.preview(indices=range(start, start + min(64, dataset.nclasses*dataset.batch_size)), ncols=dataset.batch_size)
+    print(json.dumps({'save_dir': dataset.save_dir, 'batch_range': dataset.batch_range,
+                        'completed': len(report['completed']), 'cached': report['cached'],
+                        'cancelled': report['cancelled'],
+                        'memory': report['memory']}))
+    return 1 if report['cancelled'] else 0
+
 
-    def sample_objects(self):
-        classes = {}
-        nclassobjects = np.random.randint(2, self.Kconcepts)
-        classes[0] = list(np.random.choice(self.class_rules[1], size=nclassobjects)) + \
-                        list(np.random.choice(self.class_rules[2], size=self.Kconcepts - nclassobjects))
-
-        classes[1] = list(np.random.choice(self.class_rules[1], size=self.Kconcepts))
-        classes[2] = list(np.random.choice(self.class_rules[2], size=self.Kconcepts))
-        return classes
-
-    def save_images(self, images, class_, start_idx=0):
-        path = os.path.join(self.save_dir, f'class-{class_}')
-        for i, img in enumerate(images):
-            idx = i + (start_idx)*self.batch_size*(class_+1)
-            cv2.imwrite(os.path.join(path, f'{idx}.png'), img)
-        pass
-
-
-    def create(self):
-        for ibatch in range(self.Ndatapoints//self.batch_size):
-            background = tuple([int(a) for a in np.random.randint(50, 255, 3)])
-            classes = self.sample_objects()
-
-            for key, concepts in classes.items():
-                objects = [self.object_creator.sample(n=self.batch_size, 
-                                                        type=type_) for type_ in concepts]
-                images = self.object_creator.combine(objects, background=background)
-                self.save_images(images, key, ibatch)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from src.storage import atomic_write
+
+
+class Metrics(object):
+    # counters, stage timers ([calls, seconds]) and gauges of one process,
+    # safe to update from writer threads. snapshot() is cumulative, so the
+    # latest snapshot of every process is all a Reporter needs to merge
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.gauges = {}
+        self.start = time.time()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {'pid': os.getpid(),
+                    'start': self.start,
+                    'time': time.time(),
+                    'counters': dict(self.counters),
+                    'timers': {k: list(v) for k, v in self.timers.items()},
+                    'gauges': dict(self.gauges)}
+
+
+def merge_snapshots(snapshots):
+    # sum of cumulative per-process snapshots, gauges are summed as well
+    merged = {'processes': 0, 'start': None, 'counters': {}, 'timers': {}, 'gauges': {}}
+    for snapshot in snapshots:
+        merged['processes'] += 1
+        if merged['start'] is None or snapshot['start'] < merged['start']:
+            merged['start'] = snapshot['start']
+        for name, value in snapshot['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+        for name, (calls, seconds) in snapshot['timers'].items():
+            timer = merged['timers'].setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+        for name, value in snapshot['gauges'].items():
+            merged['gauges'][name] = merged['gauges'].get(name, 0) + value
+    return merged
+
+
+class Reporter(object):
+    # keeps the latest snapshot of every process and hands the merged view
+    # to the sinks at most once per interval seconds (and on tick(force=True))
+    def __init__(self, sinks, interval=10.0):
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.latest = {}
+        self.emitted = time.monotonic()
+        self.start = time.time()
+
+    def update(self, snapshot):
+        # snapshots of one process may arrive out of order, keep the newest
+        latest = self.latest.get(snapshot['pid'])
+        if latest is None or latest['time'] <= snapshot['time']:
+            self.latest[snapshot['pid']] = snapshot
+
+    def tick(self, force=False):
+        now = time.monotonic()
+        if not self.sinks or not self.latest or (not force and now - self.emitted < self.interval):
+            return
+        self.emitted = now
+        merged = merge_snapshots(self.latest.values())
+        merged['time'] = time.time()
+        merged['elapsed'] = merged['time'] - self.start
+        elapsed = max(merged['elapsed'], 1e-9)
+        merged['rates'] = {name: value/elapsed for name, value in merged['counters'].items()}
+        for sink in self.sinks:
+            sink.emit(merged)
+
+
+class LogSink(object):
+    # one progress line per report: elapsed time, counter totals and rates,
+    # gauges and the stages taking most of the time
+    def __init__(self, stream=None, top=4):
+        self.stream = sys.stderr if stream is None else stream
+        self.top = top
+
+    def emit(self, report):
+        parts = [f"{report['elapsed']:8.1f}s"]
+        for name, value in sorted(report['counters'].items()):
+            if name.startswith('bytes'):
+                parts.append(f"{name} {value/2**20:.1f}MB ({report['rates'][name]/2**20:.1f}MB/s)")
+            else:
+                parts.append(f"{name} {value} ({report['rates'][name]:.1f}/s)")
+        parts += [f'{name} {value}' for name, value in sorted(report['gauges'].items())]
+        stages = sorted(report['timers'].items(), key=lambda item: -item[1][1])[:self.top]
+        total = sum(seconds for _, seconds in report['timers'].values()) or 1.0
+        if stages:
+            parts.append('stages ' + ' '.join(f'{name} {100*seconds/total:.0f}%' for name, (_, seconds) in stages))
+        print('[generate] ' + '  '.join(parts), file=self.stream, flush=True)
+
+
+class JSONLinesSink(object):
+    # appends every report as one json line
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, report):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+class PrometheusSink(object):
+    # overwrites path with the latest report in the Prometheus text
+    # exposition format, e.g. for the node_exporter textfile collector
+    def __init__(self, path, prefix='dataset'):
+        self.path = path
+        self.prefix = prefix
+
+    def emit(self, report):
+        p = self.prefix
+        lines = [f'# TYPE {p}_elapsed_seconds gauge', f"{p}_elapsed_seconds {report['elapsed']:.3f}",
+                    f'# TYPE {p}_processes gauge', f"{p}_processes {report['processes']}"]
+        for name, value in sorted(report['counters'].items()):
+            lines += [f'# TYPE {p}_{name}_total counter', f'{p}_{name}_total {value}']
+        for name, value in sorted(report['gauges'].items()):
+            lines += [f'# TYPE {p}_{name} gauge', f'{p}_{name} {value}']
+        if report['timers']:
+            lines += [f'# TYPE {p}_stage_seconds_total counter']
+            lines += [f'{p}_stage_seconds_total{{stage="{name}"}} {seconds:.6f}'
+                        for name, (_, seconds) in sorted(report['timers'].items())]
+            lines += [f'# TYPE {p}_stage_calls_total counter']
+            lines += [f'{p}_stage_calls_total{{stage="{name}"}} {calls}'
+                        for name, (calls, _) in sorted(report['timers'].items())]
+
+        atomic_write(self.path, lambda f: f.write('\n'.join(lines) + '\n'))
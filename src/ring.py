@@ -0,0 +1,225 @@
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+
+# Shared memory ring of nslots fixed-shape batches (images, labels,
+# concepts) in the layout of CreateDataset.generate_arrays. Batch n always
+# goes to slot n % nslots. Every producer writes its own subsequence of
+# batch numbers and every consumer owns a cursor cell (consumer_id), so all
+# control words have a single writer and no cross-process lock is needed:
+#   seq[slot]        number of the batch held by slot, -1 while it is written
+#   cursor[consumer] batches below it are released by that consumer
+#   active[consumer] 1 while the consumer is attached
+#   claim[producer]  batch the producer is waiting to write or writing, -1
+#                    between batches
+#   written[producer] batches the producer has published
+# A producer only overwrites batch n - nslots once every active cursor is past
+# it (backpressure), and waits while no consumer is attached.
+
+MAGIC = 0x52494e47
+HEADER = ['magic', 'nslots', 'batch', 'height', 'width', 'kconcepts',
+            'max_consumers', 'max_producers', 'stop', 'closed']
+
+
+class RingBuffer(object):
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        header = np.ndarray(len(HEADER), dtype=np.int64, buffer=shm.buf)
+        if header[0] != MAGIC:
+            raise ValueError(f'{shm.name} is not a ring buffer')
+        self.meta = dict(zip(HEADER, (int(v) for v in header)))
+        nslots, C, P = self.meta['nslots'], self.meta['max_consumers'], self.meta['max_producers']
+        B, H, W, K = self.meta['batch'], self.meta['height'], self.meta['width'], self.meta['kconcepts']
+
+        control = np.ndarray(len(HEADER) + nslots + 2*C + 2*P, dtype=np.int64, buffer=shm.buf)
+        self.header = control[:len(HEADER)]
+        self.seq = control[len(HEADER):len(HEADER) + nslots]
+        self.cursor = control[len(HEADER) + nslots:len(HEADER) + nslots + C]
+        self.active = control[len(HEADER) + nslots + C:len(HEADER) + nslots + 2*C]
+        self.claim = control[len(HEADER) + nslots + 2*C:len(HEADER) + nslots + 2*C + P]
+        self.written = control[len(HEADER) + nslots + 2*C + P:]
+
+        offset = self.control_bytes(nslots, C, P)
+        self.images = np.ndarray((nslots, B, H, W, 3), dtype=np.uint8, buffer=shm.buf, offset=offset)
+        offset += self.images.nbytes
+        self.labels = np.ndarray((nslots, B), dtype=np.uint8, buffer=shm.buf, offset=offset)
+        offset += self.labels.nbytes
+        self.concepts = np.ndarray((nslots, B, K), dtype=np.uint8, buffer=shm.buf, offset=offset)
+
+    @staticmethod
+    def control_bytes(nslots, max_consumers, max_producers):
+        # control words rounded up to a 4096 byte page
+        n = 8*(len(HEADER) + nslots + 2*max_consumers + 2*max_producers)
+        return -(-n//4096)*4096
+
+    @classmethod
+    def create(cls, name, nslots, batch, height, width, kconcepts, max_consumers=16, max_producers=16):
+        size = cls.control_bytes(nslots, max_consumers, max_producers) + \
+                nslots*batch*(height*width*3 + 1 + kconcepts)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        control = np.ndarray(len(HEADER) + nslots + 2*max_consumers + 2*max_producers,
+                                dtype=np.int64, buffer=shm.buf)
+        control[:] = 0
+        control[:len(HEADER)] = [MAGIC, nslots, batch, height, width, kconcepts,
+                                    max_consumers, max_producers, -1, 0]
+        ring = cls(shm, owner=True)
+        ring.seq[:] = -1
+        ring.claim[:] = -1
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        shm = shared_memory.SharedMemory(name=name)
+        # the creator owns the segment; keep this process's resource tracker
+        # from unlinking it when we exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return cls(shm)
+
+    @property
+    def nslots(self):
+        return self.meta['nslots']
+
+    @property
+    def closed(self):
+        return bool(self.header[HEADER.index('closed')])
+
+    @property
+    def stop(self):
+        # number of batches that will ever be written, -1 if unbounded
+        return int(self.header[HEADER.index('stop')])
+
+    def set_stop(self, stop):
+        self.header[HEADER.index('stop')] = -1 if stop is None else stop
+
+    @property
+    def produced(self):
+        # batches published by all producers so far
+        return int(self.written.sum())
+
+    def oldest(self, exclude=None):
+        # oldest batch not yet released by the active consumers (besides
+        # exclude) that is still held in a slot or claimed by a producer, 0
+        # on a ring nothing has been written to
+        active = self.active == 1
+        if exclude is not None:
+            active[exclude] = False
+        released = int(self.cursor[active].min()) if active.any() else 0
+        pending = [int(n) for n in self.seq if n >= released] + [int(n) for n in self.claim if n >= 0]
+        return min(pending) if pending else released
+
+    def shutdown(self):
+        self.header[HEADER.index('closed')] = 1
+
+    def close(self):
+        # drop this process's views, the creator also removes the segment
+        self.images = self.labels = self.concepts = None
+        self.header = self.seq = self.cursor = self.active = self.claim = self.written = None
+        self.shm.close()
+        if self.owner:
+            # an attach() from a process sharing our resource tracker may
+            # have unregistered the name already; unlink() unregisters it
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
+
+
+def wait(condition, timeout=None, closed=None):
+    # poll condition() with a growing sleep; False on timeout or close
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 1e-4
+    while not condition():
+        if closed is not None and closed():
+            return False
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(2*delay, 5e-3)
+    return True
+
+
+class RingProducer(object):
+    # writes batches of its own sequence into the ring; write() blocks
+    # until the slot is free of unread data
+    def __init__(self, ring, producer_id=0):
+        if not 0 <= producer_id < ring.meta['max_producers']:
+            raise ValueError(f'producer_id {producer_id} out of range')
+        self.ring = ring
+        self.producer_id = producer_id
+
+    def writable(self, n):
+        ring = self.ring
+        active = ring.active == 1
+        return active.any() and bool((ring.cursor[active] > n - ring.nslots).all())
+
+    def write(self, n, images, labels, concepts, timeout=None):
+        ring = self.ring
+        if ring.closed:
+            return False
+        ring.claim[self.producer_id] = n
+        if not wait(lambda: self.writable(n), timeout, lambda: ring.closed):
+            return False
+        slot = n % ring.nslots
+        ring.seq[slot] = -1
+        ring.images[slot] = images
+        ring.labels[slot] = labels
+        ring.concepts[slot] = concepts
+        ring.seq[slot] = n
+        ring.claim[self.producer_id] = -1
+        ring.written[self.producer_id] += 1
+        return True
+
+
+class RingConsumer(object):
+    # reads batches in order. next() returns zero-copy views of the batch,
+    # valid until the following next() or close(), which release it to the
+    # producers.
+    # A consumer attached before anything was written starts at batch 0.
+    # One attaching later starts at the oldest batch the other consumers have
+    # not released yet (still in the ring or claimed by a producer), so it
+    # reads in step with them. A slot a producer was already overwriting
+    # while we attached is skipped.
+    def __init__(self, ring, consumer_id=0):
+        if not 0 <= consumer_id < ring.meta['max_consumers']:
+            raise ValueError(f'consumer_id {consumer_id} out of range')
+        if ring.active[consumer_id]:
+            raise ValueError(f'consumer_id {consumer_id} is already attached')
+        self.ring = ring
+        self.consumer_id = consumer_id
+        # hold every slot while the start is looked up, then move to it
+        ring.cursor[consumer_id] = 0
+        ring.active[consumer_id] = 1
+        self.position = ring.oldest(exclude=consumer_id)
+        ring.cursor[consumer_id] = self.position
+
+    def next(self, timeout=None):
+        ring = self.ring
+        n = self.position
+        ring.cursor[self.consumer_id] = n
+        if 0 <= ring.stop <= n:
+            raise StopIteration
+        slot = n % ring.nslots
+        while ring.seq[slot] > n:
+            # overwritten before this consumer was attached
+            n += 1
+            ring.cursor[self.consumer_id] = n
+            if 0 <= ring.stop <= n:
+                raise StopIteration
+            slot = n % ring.nslots
+        if not wait(lambda: ring.seq[slot] == n, timeout, lambda: ring.closed):
+            if ring.closed:
+                raise StopIteration
+            raise TimeoutError(f'batch {n} not produced within {timeout}s')
+        self.position = n + 1
+        return ring.images[slot], ring.labels[slot], ring.concepts[slot]
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.next()
+            except StopIteration:
+                return
+
+    def close(self):
+        if self.ring.active is not None:
+            self.ring.active[self.consumer_id] = 0
@@ -0,0 +1,96 @@
+import json
+import numpy as np
+
+
+class Stats(object):
+    # per-class accumulators of the generated images: sample counts, exact
+    # integer per-channel (BGR) sums and sums of squares, and concept type
+    # frequencies. Everything is a plain count, so accumulators of batches,
+    # workers or runs merge by addition and round-trip through json.
+    def __init__(self):
+        self.classes = {}
+
+    def entry(self, class_):
+        key = str(class_)
+        if key not in self.classes:
+            self.classes[key] = {'count': 0,
+                                'pixels': 0,
+                                'sum': [0, 0, 0],
+                                'sumsq': [0, 0, 0],
+                                'concepts': {}}
+        return self.classes[key]
+
+    def update(self, class_, images, concepts=None):
+        # images: (n, H, W, 3) uint8. Moments come from a 256 bin int64
+        # histogram per channel, which is cheaper than squaring the batch and
+        # exact at any size (cv2.calcHist counts in float32)
+        entry = self.entry(class_)
+        n = len(images)
+        flat = np.ascontiguousarray(images).reshape(-1, 3)
+        values = np.arange(256, dtype=np.int64)
+        for c in range(3):
+            hist = np.bincount(flat[:, c], minlength=256)
+            entry['sum'][c] += int(hist @ values)
+            entry['sumsq'][c] += int(hist @ values**2)
+        entry['count'] += n
+        entry['pixels'] += n*images.shape[1]*images.shape[2]
+        for concept in concepts or []:
+            entry['concepts'][str(concept)] = entry['concepts'].get(str(concept), 0) + n
+        return self
+
+    def merge(self, other):
+        for key, src in other.classes.items():
+            entry = self.entry(key)
+            entry['count'] += src['count']
+            entry['pixels'] += src['pixels']
+            for c in range(3):
+                entry['sum'][c] += src['sum'][c]
+                entry['sumsq'][c] += src['sumsq'][c]
+            for concept, count in src['concepts'].items():
+                entry['concepts'][concept] = entry['concepts'].get(concept, 0) + count
+        return self
+
+    def to_dict(self):
+        return json.loads(json.dumps(self.classes))
+
+    @classmethod
+    def from_dict(cls, classes):
+        stats = cls()
+        stats.classes = json.loads(json.dumps(classes))
+        return stats
+
+    @staticmethod
+    def moments(entry):
+        pixels = max(entry['pixels'], 1)
+        mean = np.array(entry['sum'])/pixels
+        var = np.maximum(np.array(entry['sumsq'])/pixels - mean**2, 0)
+        return mean.tolist(), np.sqrt(var).tolist()
+
+    def summary(self):
+        # mean/std (BGR, 0-255), counts and concept frequencies per class and
+        # over the whole dataset
+        total = Stats()
+        classes = {}
+        for key in sorted(self.classes, key=int):
+            entry = self.classes[key]
+            total.merge(Stats.from_dict({'all': entry}))
+            mean, std = self.moments(entry)
+            classes[key] = {'count': entry['count'],
+                            'mean': mean,
+                            'std': std,
+                            'concepts': dict(sorted(entry['concepts'].items()))}
+        summary = {'count': 0, 'mean': [0.0]*3, 'std': [0.0]*3, 'concepts': {}}
+        if total.classes:
+            entry = total.classes['all']
+            mean, std = self.moments(entry)
+            summary = {'count': entry['count'],
+                        'mean': mean,
+                        'std': std,
+                        'concepts': dict(sorted(entry['concepts'].items()))}
+        return {'classes': classes, 'total': summary}
+
+    def save(self, path):
+        # storage imports this module
+        from src.storage import atomic_write
+        report = dict(self.summary(), accumulators=self.classes)
+        atomic_write(path, lambda f: json.dump(report, f, indent=2))
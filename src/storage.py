@@ -0,0 +1,643 @@
+import cv2
+import os
+import json
+import shutil
+import threading
+from collections import deque
+from functools import partial
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait
+from src.utils import unpack_mask
+from src.stats import Stats
+
+
+def sample_index(ibatch, class_, nclasses, batch_size):
+    # global index of the first sample of (ibatch, class_); the i-th image of
+    # that class batch is sample_index(...) + i, unique across the dataset
+    return (ibatch*nclasses + class_)*batch_size
+
+
+def atomic_write(path, writer, mode='w'):
+    # writer(f) fills a temporary file that then replaces path in one rename,
+    # so readers (and hard links to the old file) never see a partial write
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, mode) as f:
+        writer(f)
+    os.replace(tmp, path)
+
+
+def unshare(path):
+    # files of a save_dir may be hard links into a DatasetCache entry; one
+    # about to be changed in place is first replaced by a private copy
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        with open(path, 'rb') as src:
+            atomic_write(path, partial(shutil.copyfileobj, src), 'wb')
+
+
+def unlink_shared(path):
+    # drops a hard-linked file that is about to be rewritten as a whole, so
+    # the write goes to a new inode; a stat per file, nothing when unshared
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class PNGWriter(object):
+    # one png per sample in class-{i} folders, named by global sample index
+    def __init__(self, dataset):
+        self.save_dir = dataset.save_dir
+        self.nclasses = dataset.nclasses
+        self.batch_size = dataset.batch_size
+
+    def open(self):
+        os.makedirs(self.save_dir, exist_ok=True)
+        for i in range(self.nclasses):
+            os.makedirs(os.path.join(self.save_dir, f'class-{i}'), exist_ok=True)
+
+    def write(self, ibatch, class_, concepts, images, offset=0):
+        path = os.path.join(self.save_dir, f'class-{class_}')
+        start = sample_index(ibatch, class_, self.nclasses, self.batch_size) + offset
+        nbytes = 0
+        for i, img in enumerate(images):
+            ok, encoded = cv2.imencode('.png', img)
+            if not ok:
+                raise IOError(f'could not encode sample {start + i}')
+            name = os.path.join(path, f'{start + i}.png')
+            unlink_shared(name)
+            with open(name, 'wb') as f:
+                f.write(encoded)
+            nbytes += encoded.nbytes
+        return nbytes
+
+    def barrier(self, callback):
+        callback()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NpyWriter(object):
+    # fixed-shape uint8 shards images-{s}.npy of shard_size samples plus
+    # labels.npy / concepts.npy side arrays, all preallocated by open() so
+    # that every process can write its batches in place through a memmap.
+    # Samples of the dataset's batch_range are stored at sample_index - start.
+    def __init__(self, dataset, shard_size=4096):
+        self.save_dir = dataset.save_dir
+        self.nclasses = dataset.nclasses
+        self.batch_size = dataset.batch_size
+        self.concept_names = dataset.concept_names
+        first, last = dataset.batch_range
+        self.start = sample_index(first, 0, dataset.nclasses, dataset.batch_size)
+        self.nsamples = (last - first)*dataset.nclasses*dataset.batch_size
+        self.shape = (dataset.height, dataset.width, 3)
+        self.Kconcepts = dataset.Kconcepts
+        self.shard_size = shard_size
+        self.maps = {}
+
+    @property
+    def nshards(self):
+        return -(-self.nsamples//self.shard_size)
+
+    def open(self):
+        os.makedirs(self.save_dir, exist_ok=True)
+        meta = {'start': self.start,
+                'nsamples': self.nsamples,
+                'shard_size': self.shard_size,
+                'nshards': self.nshards,
+                'shape': list(self.shape),
+                'nclasses': self.nclasses,
+                'Kconcepts': self.Kconcepts,
+                'concept_names': self.concept_names}
+        atomic_write(os.path.join(self.save_dir, 'meta.json'), lambda f: json.dump(meta, f, indent=2))
+
+        for s in range(self.nshards):
+            n = min(self.shard_size, self.nsamples - s*self.shard_size)
+            self.create(f'images-{s:05d}.npy', (n, *self.shape))
+        self.create('labels.npy', (self.nsamples,))
+        self.create('concepts.npy', (self.nsamples, self.Kconcepts))
+        self.maps = {}
+
+    def create(self, name, shape):
+        path = os.path.join(self.save_dir, name)
+        # kept shards are written through r+ memmaps, so they must not be
+        # shared; others are recreated as new files
+        if os.path.exists(path):
+            header = np.load(path, mmap_mode='r')
+            if header.shape == shape and header.dtype == np.uint8:
+                unshare(path)
+                return
+            os.remove(path)
+        np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+
+    def map(self, name):
+        # memmaps are opened lazily so forked workers get their own mapping
+        key = (os.getpid(), name)
+        if key not in self.maps:
+            self.maps.setdefault(key, np.load(os.path.join(self.save_dir, name), mmap_mode='r+'))
+        return self.maps[key]
+
+    def write(self, ibatch, class_, concepts, images, offset=0):
+        # images are samples offset, offset + 1, ... of the class batch
+        start = sample_index(ibatch, class_, self.nclasses, self.batch_size) + offset - self.start
+        stop = start + len(images)
+        nbytes = images.nbytes
+        self.map('labels.npy')[start:stop] = class_
+        if concepts is not None:
+            self.map('concepts.npy')[start:stop] = [self.concept_names.index(c) for c in concepts]
+
+        while start < stop:
+            s, offset = divmod(start, self.shard_size)
+            n = min(stop - start, self.shard_size - offset)
+            self.map(f'images-{s:05d}.npy')[offset:offset + n] = images[:n]
+            images = images[n:]
+            start += n
+        return nbytes
+
+    def barrier(self, callback):
+        callback()
+
+    def flush(self):
+        for key, array in self.maps.items():
+            if key[0] == os.getpid():
+                array.flush()
+
+    def close(self):
+        self.flush()
+        self.maps = {}
+
+
+class NpyReader(object):
+    # read side of NpyWriter: every shard is memory mapped read-only, so
+    # slices inside one shard are zero-copy views. Positions are relative to
+    # meta['start'], the global index of the first stored sample
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        with open(os.path.join(save_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.start = self.meta.get('start', 0)
+        self.shard_size = self.meta['shard_size']
+        self.concept_names = self.meta['concept_names']
+        self.labels = np.load(os.path.join(save_dir, 'labels.npy'), mmap_mode='r')
+        self.concepts = np.load(os.path.join(save_dir, 'concepts.npy'), mmap_mode='r')
+        self.shards = [np.load(os.path.join(save_dir, f'images-{s:05d}.npy'), mmap_mode='r')
+                        for s in range(self.meta['nshards'])]
+
+    def __len__(self):
+        return self.meta['nsamples']
+
+    def batch(self, start, stop):
+        parts = []
+        i = start
+        while i < stop:
+            s, offset = divmod(i, self.shard_size)
+            n = min(stop - i, self.shard_size - offset)
+            parts.append(self.shards[s][offset:offset + n])
+            i += n
+        images = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return images, self.labels[start:stop], self.concepts[start:stop]
+
+    def __getitem__(self, i):
+        s, offset = divmod(i, self.shard_size)
+        return self.shards[s][offset], self.labels[i], self.concepts[i]
+
+
+class PyramidWriter(object):
+    # writes every batch with writer and, area-downsampled, with the writer
+    # of each smaller level; levels are (height, width, writer) from large
+    # to small area and every level is resized from the smallest image
+    # already made that is at least as large in both dimensions
+    def __init__(self, writer, levels):
+        self.writer = writer
+        self.levels = levels
+
+    def open(self):
+        self.writer.open()
+        for _, _, writer in self.levels:
+            writer.open()
+
+    def write(self, ibatch, class_, concepts, images, offset=0):
+        nbytes = self.writer.write(ibatch, class_, concepts, images, offset) or 0
+        made = [images]
+        for height, width, writer in self.levels:
+            source = min((m for m in made if m.shape[1] >= height and m.shape[2] >= width),
+                            key=lambda m: m.shape[1]*m.shape[2])
+            scaled = np.empty((len(images), height, width, 3), dtype=np.uint8)
+            for i, image in enumerate(source):
+                cv2.resize(image, (width, height), dst=scaled[i], interpolation=cv2.INTER_AREA)
+            nbytes += writer.write(ibatch, class_, concepts, scaled, offset) or 0
+            made.append(scaled)
+        return nbytes
+
+    def barrier(self, callback):
+        callback()
+
+    def flush(self):
+        self.writer.flush()
+        for _, _, writer in self.levels:
+            writer.flush()
+
+    def close(self):
+        self.writer.close()
+        for _, _, writer in self.levels:
+            writer.close()
+
+
+class PNGReader(object):
+    # read side of PNGWriter. The (index, label) file list of the class-{i}
+    # folders is built once and cached in png-index.npz (rebuilt when the
+    # manifest is newer); batches are decoded by a thread pool, cv2 releases
+    # the GIL, into preallocated (B, H, W, 3) uint8 buffers
+    def __init__(self, save_dir, threads=8, refresh=False):
+        self.save_dir = save_dir
+        self.threads = threads
+        self.index, self.labels = self.load_index(refresh)
+        if len(self.index):
+            self.shape = self.imread(0).shape
+
+    def load_index(self, refresh=False):
+        path = os.path.join(self.save_dir, 'png-index.npz')
+        manifest = os.path.join(self.save_dir, 'manifest.jsonl')
+        if not refresh and os.path.exists(path) and \
+                (not os.path.exists(manifest) or os.path.getmtime(manifest) <= os.path.getmtime(path)):
+            with np.load(path) as data:
+                return data['index'], data['labels']
+
+        index, labels = [], []
+        for entry in os.scandir(self.save_dir):
+            if not (entry.is_dir() and entry.name.startswith('class-')):
+                continue
+            class_ = int(entry.name[len('class-'):])
+            names = [f.name[:-4] for f in os.scandir(entry.path) if f.name.endswith('.png')]
+            index.extend(int(name) for name in names)
+            labels.extend([class_]*len(names))
+        order = np.argsort(index, kind='stable')
+        index = np.array(index, dtype=np.int64)[order]
+        labels = np.array(labels, dtype=np.uint8)[order]
+        atomic_write(path, lambda f: np.savez(f, index=index, labels=labels), 'wb')
+        return index, labels
+
+    def __len__(self):
+        return len(self.index)
+
+    def path(self, position):
+        return os.path.join(self.save_dir, f'class-{self.labels[position]}', f'{self.index[position]}.png')
+
+    def imread(self, position):
+        image = cv2.imread(self.path(position))
+        if image is None:
+            raise IOError(f'could not read {self.path(position)}')
+        return image
+
+    def decode(self, position, out):
+        image = self.imread(position)
+        if image.shape != out.shape:
+            raise ValueError(f'{self.path(position)} has shape {image.shape}, expected {out.shape}')
+        out[...] = image
+
+    def read(self, positions, out=None, executor=None):
+        # (images, labels, global indices) of the given positions of the index
+        positions = np.asarray(positions)
+        out = np.empty((len(positions), *self.shape), dtype=np.uint8) if out is None else out[:len(positions)]
+        if executor is None:
+            with ThreadPoolExecutor(self.threads) as executor:
+                return self.read(positions, out, executor)
+        for future in [executor.submit(self.decode, p, out[i]) for i, p in enumerate(positions)]:
+            future.result()
+        return out, self.labels[positions], self.index[positions]
+
+    def batches(self, batch_size, shuffle=True, seed=None, prefetch=2, drop_last=False):
+        # yields (images, labels, indices) of one pass over the index while
+        # up to prefetch later batches are decoded. Images live in one of
+        # prefetch + 1 reused buffers and stay valid until the next step
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        stop = len(order) - len(order) % batch_size if drop_last else len(order)
+        starts = range(0, stop, batch_size)
+        buffers = [np.empty((batch_size, *self.shape), dtype=np.uint8) for _ in range(prefetch + 1)]
+
+        pending = deque()
+        with ThreadPoolExecutor(self.threads) as executor:
+            try:
+                for j, start in enumerate(starts):
+                    positions = order[start:start + batch_size]
+                    out = buffers[j % len(buffers)][:len(positions)]
+                    futures = [executor.submit(self.decode, p, out[i]) for i, p in enumerate(positions)]
+                    pending.append((positions, out, futures))
+                    if len(pending) > prefetch:
+                        yield self.finish(*pending.popleft())
+                while pending:
+                    yield self.finish(*pending.popleft())
+            finally:
+                for _, _, futures in pending:
+                    for future in futures:
+                        future.cancel()
+
+    def finish(self, positions, out, futures):
+        for future in futures:
+            future.result()
+        return out, self.labels[positions], self.index[positions]
+
+
+class AnnotationWriter(object):
+    # columnar per-object annotations (see utils.pack_annotations) of every
+    # class batch (or sub-batch) in annotations/{start}.npz, keyed by the
+    # global sample index of its first sample so parallel workers never share
+    # a file
+    def __init__(self, dataset):
+        self.path = os.path.join(dataset.save_dir, 'annotations')
+        self.nclasses = dataset.nclasses
+        self.batch_size = dataset.batch_size
+        self.concept_names = dataset.concept_names
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def clear(self):
+        # files of a previous dataset in save_dir, before a fresh run
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.path, name))
+
+    def write(self, ibatch, class_, annotations, offset=0):
+        start = sample_index(ibatch, class_, self.nclasses, self.batch_size) + offset
+        path = os.path.join(self.path, f'{start:010d}.npz')
+        atomic_write(path, lambda f: np.savez(f,
+                    index=start + annotations['image'].astype(np.int64),
+                    concept=np.array([self.concept_names.index(t) for t in annotations['type']], dtype=np.uint8),
+                    order=annotations['order'],
+                    slot=annotations['slot'],
+                    box=annotations['box'],
+                    mask_offset=annotations['mask_offset'],
+                    masks=annotations['masks']), 'wb')
+
+
+class AnnotationReader(object):
+    # all annotation files of a dataset as one set of columns, rows sorted by
+    # (index, order); rows(i) are the objects of sample i and mask(j) is the
+    # boolean mask of row j cropped to box[j]
+
+    # dtype and row shape of every column as AnnotationWriter stores them,
+    # used for the columns of a dataset without any annotation file
+    COLUMNS = {'index': (np.int64, ()),
+                'concept': (np.uint8, ()),
+                'order': (np.uint8, ()),
+                'slot': (np.uint8, ()),
+                'box': (np.int16, (4,)),
+                'mask_offset': (np.int64, ()),
+                'masks': (np.uint8, ())}
+
+    def __init__(self, save_dir):
+        path = os.path.join(save_dir, 'annotations')
+        names = sorted(n for n in os.listdir(path) if n.endswith('.npz'))
+        columns = {k: [] for k in self.COLUMNS}
+        base = 0
+        for name in names:
+            with np.load(os.path.join(path, name)) as data:
+                for key in columns:
+                    if key == 'mask_offset':
+                        columns[key].append(data[key][:-1] + base)
+                    else:
+                        columns[key].append(data[key])
+                base += len(data['masks'])
+        for key, parts in columns.items():
+            dtype, shape = self.COLUMNS[key]
+            columns[key] = np.concatenate(parts) if parts else np.empty((0, *shape), dtype)
+        columns['mask_offset'] = np.append(columns['mask_offset'], base).astype(np.int64)
+        self.columns = columns
+        self.index = columns['index']
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def rows(self, i):
+        return range(np.searchsorted(self.index, i, 'left'), np.searchsorted(self.index, i, 'right'))
+
+    def mask(self, j, shape=None):
+        return unpack_mask(self.columns, j, shape)
+
+
+class InstrumentedWriter(object):
+    # times every write of writer and counts the images and bytes written
+    # into a metrics.Metrics; sits below AsyncWriter so the time is the
+    # actual encode and io, not the queueing
+    def __init__(self, writer, metrics):
+        self.writer = writer
+        self.metrics = metrics
+
+    def open(self):
+        self.writer.open()
+
+    def write(self, ibatch, class_, concepts, images, offset=0):
+        with self.metrics.timer('write'):
+            nbytes = self.writer.write(ibatch, class_, concepts, images, offset)
+        self.metrics.add('images_written', len(images))
+        self.metrics.add('bytes_written', nbytes or 0)
+        return nbytes
+
+    def barrier(self, callback):
+        self.writer.barrier(callback)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncWriter(object):
+    # runs writer.write on a thread pool so png encoding and file io (both
+    # release the GIL) overlap with generation. At most depth writes are in
+    # flight, beyond that write() blocks; flush() waits for all of them and
+    # re-raises the first error. Threads are started lazily per process.
+    def __init__(self, writer, threads=4, depth=None, metrics=None):
+        self.writer = writer
+        self.threads = threads
+        self.depth = depth or 2*threads
+        self.metrics = metrics
+        self.pid = None
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.slots = threading.BoundedSemaphore(self.depth)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.unacknowledged = []
+        self.error = None
+        self.pid = os.getpid()
+
+    def open(self):
+        self.writer.open()
+
+    def write(self, *args):
+        self.start()
+        if self.error is not None:
+            raise self.error
+        self.slots.acquire()
+        future = self.executor.submit(self.writer.write, *args)
+        with self.lock:
+            self.pending.add(future)
+            if self.metrics is not None:
+                self.metrics.gauge('write_queue', len(self.pending))
+        self.unacknowledged.append(future)
+        future.add_done_callback(self.done)
+
+    def barrier(self, callback):
+        # run callback once every write issued since the last barrier is done,
+        # queued like a write so flush() also waits for it
+        futures, self.unacknowledged = self.unacknowledged, []
+        self.start()
+        self.slots.acquire()
+        future = self.executor.submit(self.run_barrier, futures, callback)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+
+    def run_barrier(self, futures, callback):
+        wait(futures)
+        for future in futures:
+            if future.exception() is not None:
+                return
+        callback()
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if self.metrics is not None:
+                self.metrics.gauge('write_queue', len(self.pending))
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+        self.slots.release()
+
+    def flush(self):
+        if self.pid == os.getpid():
+            with self.lock:
+                pending = list(self.pending)
+            wait(pending)
+            if self.error is not None:
+                raise self.error
+        self.writer.flush()
+
+    def close(self):
+        self.flush()
+        if self.pid == os.getpid():
+            self.executor.shutdown()
+            self.pid = None
+        self.writer.close()
+
+
+class Manifest(object):
+    # append-only jsonl log: a header line with the dataset config followed by
+    # one line per completed batch. Lines are appended with a single
+    # O_APPEND write so concurrent workers never interleave, and a torn last
+    # line from a killed run is ignored on load.
+    def __init__(self, save_dir, name='manifest.jsonl'):
+        self.path = os.path.join(save_dir, name)
+
+    def reset(self, config):
+        atomic_write(self.path, lambda f: f.write(json.dumps({'config': config}) + '\n'))
+
+    def append(self, record):
+        line = (json.dumps(record) + '\n').encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def repair(self):
+        # drop a torn last line so new records start on a fresh line
+        # called before appending to a previous run's manifest
+        if not os.path.exists(self.path):
+            return
+        unshare(self.path)
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def load(self):
+        # (config, {ibatch: record}) of a previous run, (None, {}) if none
+        config, records = None, {}
+        if not os.path.exists(self.path):
+            return config, records
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'config' in record:
+                    config = record['config']
+                else:
+                    records[record['batch']] = record
+        return config, records
+
+
+def merge_shards(save_dir):
+    # join the shard-*-of-* folders of a sharded run: checks that the shards
+    # describe the same dataset, writes the merged manifest (records tagged
+    # with their shard folder), stats.json and index.json to save_dir and
+    # returns the index
+    names = sorted(n for n in os.listdir(save_dir)
+                    if n.startswith('shard-') and os.path.isdir(os.path.join(save_dir, n)))
+    shards, records, config = [], {}, None
+    for name in names:
+        shard_config, shard_records = Manifest(os.path.join(save_dir, name)).load()
+        if shard_config is None:
+            continue
+        shared = {k: v for k, v in shard_config.items() if k not in ('shard_id', 'batch_range')}
+        if config is None:
+            config = shared
+        elif shared != config:
+            raise ValueError(f'{name} belongs to a different dataset: ', shard_config)
+        first, last = shard_config['batch_range']
+        nclasses, batch_size = shard_config['nclasses'], shard_config['batch_size']
+        shards.append({'path': name,
+                        'shard_id': shard_config['shard_id'],
+                        'batch_range': [first, last],
+                        'sample_range': [sample_index(first, 0, nclasses, batch_size),
+                                        sample_index(last, 0, nclasses, batch_size)],
+                        'completed': len(shard_records)})
+        for ibatch, record in shard_records.items():
+            records[ibatch] = dict(record, shard=name)
+    if config is None:
+        raise ValueError(f'no shard manifests found in {save_dir}')
+
+    nbatches = config['N']//config['batch_size']
+    owners = {}
+    for shard in shards:
+        owners.setdefault(shard['shard_id'], shard)
+    missing_shards = sorted(set(range(config['num_shards'])) - set(owners))
+    missing = sorted(set(range(nbatches)) - set(records))
+
+    manifest = Manifest(save_dir)
+    manifest.reset(dict(config, shard_id=None, batch_range=[0, nbatches]))
+    stats = Stats()
+    for ibatch in sorted(records):
+        manifest.append(records[ibatch])
+        stats.merge(Stats.from_dict(records[ibatch].get('stats', {})))
+    stats.save(os.path.join(save_dir, 'stats.json'))
+
+    index = {'config': config,
+                'nshards': len(shards),
+                'shards': sorted(shards, key=lambda shard: shard['shard_id']),
+                'missing_shards': missing_shards,
+                'completed': len(records),
+                'missing': missing}
+    atomic_write(os.path.join(save_dir, 'index.json'), lambda f: json.dump(index, f, indent=2))
+    return index
+
+
+WRITERS = {'png': PNGWriter,
+            'npy': NpyWriter}
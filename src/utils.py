@@ -1,11 +1,128 @@
+import os
 import cv2
-from imgaug import augmenters as iaa
-from matplotlib.patches import RegularPolygon
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-from matplotlib.ticker import FormatStrFormatter
+import json
+import hashlib
 import numpy as np
 import math
+import threading
+from contextlib import nullcontext
+from src.visualize import show_image
+
+
+def mask_boxes(masks):
+    # tight (y0, y1, x0, x1) boxes of (n, h, w) masks, end exclusive
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    h, w = rows.shape[1], cols.shape[1]
+    boxes = np.stack([rows.argmax(1), h - rows[:, ::-1].argmax(1),
+                        cols.argmax(1), w - cols[:, ::-1].argmax(1)], axis=1)
+    boxes[~rows.any(axis=1)] = 0
+    return boxes
+
+
+class Sprites(object):
+    # n objects stored as premultiplied BGRA tiles that share one canvas
+    # window (origin is the canvas (y, x) of pixels[:, 0, 0]) together with
+    # the tight canvas box of every object's coverage and the concept type
+    def __init__(self, pixels, origin=(0, 0), boxes=None, type=None):
+        self.pixels = pixels
+        self.origin = origin
+        self.type = type
+        if boxes is None:
+            boxes = mask_boxes(pixels[..., 3] > 0)
+            boxes[:, :2] += origin[0]
+            boxes[:, 2:] += origin[1]
+        self.boxes = boxes
+
+    def __len__(self):
+        return len(self.pixels)
+
+    @classmethod
+    def from_frames(cls, frames, threshold=10):
+        # full (n, H, W, 3) frames, pixels below threshold are background
+        alpha = np.uint8(255)*(frames.max(axis=-1) >= threshold)
+        pixels = np.concatenate([frames*(alpha[..., None] > 0), alpha[..., None]], axis=-1)
+        return cls(pixels)
+
+
+def pack_annotations(objects):
+    # columnar annotations of composited objects given as (image, order,
+    # type, slot, box, bits) tuples: box is the tight (y0, y1, x0, x1) canvas
+    # box of the mask and bits its np.packbits row-major crop, concatenated
+    # into masks with object j at masks[mask_offset[j]:mask_offset[j + 1]]
+    lengths = [len(o[5]) for o in objects]
+    return {'image': np.array([o[0] for o in objects], dtype=np.int32),
+            'order': np.array([o[1] for o in objects], dtype=np.uint8),
+            'type': [o[2] for o in objects],
+            'slot': np.array([o[3] for o in objects], dtype=np.uint8),
+            'box': np.array([o[4] for o in objects], dtype=np.int16).reshape(-1, 4),
+            'mask_offset': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            'masks': np.concatenate([o[5] for o in objects] + [np.empty(0, np.uint8)])}
+
+
+def concat_annotations(parts):
+    # one set of columns from (offset, annotations) of consecutive
+    # sub-batches, image indices shifted by their sub-batch offset
+    masks = [a['masks'] for _, a in parts]
+    bases = np.cumsum([0] + [len(m) for m in masks])
+    return {'image': np.concatenate([a['image'] + offset for offset, a in parts]).astype(np.int32),
+            'order': np.concatenate([a['order'] for _, a in parts]),
+            'type': [t for _, a in parts for t in a['type']],
+            'slot': np.concatenate([a['slot'] for _, a in parts]),
+            'box': np.concatenate([a['box'] for _, a in parts]).reshape(-1, 4),
+            'mask_offset': np.concatenate([[0]] + [a['mask_offset'][1:] + base
+                                            for (_, a), base in zip(parts, bases)]).astype(np.int64),
+            'masks': np.concatenate(masks + [np.empty(0, np.uint8)])}
+
+
+def unpack_mask(annotations, j, shape=None):
+    # boolean mask of object j, cropped to its box or placed on a canvas of shape
+    y0, y1, x0, x1 = (int(v) for v in annotations['box'][j])
+    bits = annotations['masks'][annotations['mask_offset'][j]:annotations['mask_offset'][j + 1]]
+    crop = np.unpackbits(bits, count=(y1 - y0)*(x1 - x0)).reshape(y1 - y0, x1 - x0).astype(bool)
+    if shape is None:
+        return crop
+    mask = np.zeros(shape, dtype=bool)
+    mask[y0:y1, x0:x1] = crop
+    return mask
+
+
+class SpriteBank(object):
+    # pre-rendered, already rotated and sheared variants of every concept
+    # type as coverage (alpha) tiles. tiles[type] is (size, th, tw) uint8 with
+    # variant i in [i, :h, :w], boxes[type] holds (y, x, h, w) per variant
+    # where (y, x) is its canvas corner before translation
+    def __init__(self, tiles, boxes, meta=None):
+        self.tiles = tiles
+        self.boxes = boxes
+        self.meta = meta
+
+    def __len__(self):
+        return len(next(iter(self.tiles.values())))
+
+    def save(self, path):
+        # written to a temporary file and renamed so concurrent runs never
+        # read a half written bank
+        arrays = {'meta': np.array(json.dumps(self.meta))}
+        for type_ in self.tiles:
+            arrays[f'{type_}-tiles'] = self.tiles[type_]
+            arrays[f'{type_}-boxes'] = self.boxes[type_]
+        # storage imports this module
+        from src.storage import atomic_write
+        atomic_write(path, lambda f: np.savez(f, **arrays), 'wb')
+
+    @classmethod
+    def load(cls, path, meta):
+        # the cached bank at path if it was built with meta, else None
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if json.loads(str(data['meta'])) != meta:
+                return None
+            tiles = {t: data[f'{t}-tiles'] for t in meta['types']}
+            boxes = {t: data[f'{t}-boxes'] for t in meta['types']}
+        return cls(tiles, boxes, meta)
+
 
 class CreateObject(object):
     def __init__(self, height, width):
@@ -13,20 +130,30 @@ class CreateObject(object):
         self.width = width
         self.min_object = self.height//10
         self.max_object = self.height//5
-
-        self.transform = iaa.Sequential([
-                            iaa.Affine(rotate=(-90, 90),
-                                        shear=(-25, 25),
-                                        mode='symmetric'),
-                        ]) 
-
-        self.translate= {1: iaa.Affine(translate_percent={"x": (-0.03, 0.03), "y": (-0.03, 0.03)}),
-                          2: iaa.Affine(translate_percent={"x": (-0.24, -0.20), "y": (0.20, 0.24)}),
-                          3: iaa.Affine(translate_percent={"x": (0.20, 0.24), "y": (0.20, 0.24)}),
-                          4: iaa.Affine(translate_percent={"x": (0.20, 0.24), "y": (-0.24, -0.20)}),
-                          5: iaa.Affine(translate_percent={"x": (-0.24, -0.20), "y": (-0.20, -0.15)}),
-                        }  
-        self.noise_aug = iaa.AdditiveGaussianNoise(scale=(10, 10))
+        # lower bound of the long side of capsules and ellipses, kept below
+        # max_object for heights like 64 or 512 where 2*min_object == max_object
+        self.min_long = min(2*self.min_object, self.max_object - 1)
+
+        # rotation/shear (degrees) applied around the canvas centre and the
+        # per-slot translation (fraction of the canvas), fused into one warp
+        self.rotate = (-90, 90)
+        self.shear = (-25, 25)
+        self.border_mode = cv2.BORDER_REFLECT
+        self.translate= {1: {"x": (-0.03, 0.03), "y": (-0.03, 0.03)},
+                          2: {"x": (-0.24, -0.20), "y": (0.20, 0.24)},
+                          3: {"x": (0.20, 0.24), "y": (0.20, 0.24)},
+                          4: {"x": (0.20, 0.24), "y": (-0.24, -0.20)},
+                          5: {"x": (-0.24, -0.20), "y": (-0.20, -0.15)},
+                        }
+        self.noise_scale = 10
+        self.rng = np.random.default_rng()
+        # {thread id: {name: array}}, see buffer
+        self.buffers = {}
+        self.chunk_bytes = 2**24
+        # SpriteBank of the sprite_bank mode, see load_bank
+        self.bank = None
+        # optional metrics.Metrics timing the compositing stages
+        self.metrics = None
 
         self.objects = {'circle': self.create_circle,
                         'square': self.create_square,
@@ -37,6 +164,40 @@ class CreateObject(object):
                         'capsule': self.create_capsule,
                         'triangle': self.create_polygon(3)}
 
+        # vectorized counterparts of self.objects used by sample_batch: the
+        # parameter draws and the coverage of a batch of drawn parameters
+        self.batch_params = {'circle': self.draw_circle,
+                            'square': self.draw_sizes,
+                            'hexagon': self.draw_sizes,
+                            'pentagon': self.draw_sizes,
+                            'octagon': self.draw_sizes,
+                            'ellipse': self.draw_ellipse,
+                            'capsule': self.draw_capsule,
+                            'triangle': self.draw_sizes}
+        self.batch_masks = {'circle': self.mask_circle,
+                            'square': self.mask_square,
+                            'hexagon': self.mask_polygon(6),
+                            'pentagon': self.mask_polygon(5),
+                            'octagon': self.mask_polygon(8),
+                            'ellipse': self.mask_ellipse,
+                            'capsule': self.mask_capsule,
+                            'triangle': self.mask_polygon(3)}
+
+        # every primitive is drawn around the canvas centre (polygons are
+        # offset by up to 1.5*max_object), so coverage tests only need to run
+        # over this window instead of the full canvas
+        y0 = max(self.height//2 - self.max_object - 1, 0)
+        y1 = min(self.height//2 + 3*self.max_object//2 + 2, self.height)
+        x0 = max(self.width//2 - self.max_object - 1, 0)
+        x1 = min(self.width//2 + 3*self.max_object//2 + 2, self.width)
+        self.window = (y0, y1, x0, x1)
+        self.grid_y = np.arange(y0, y1, dtype=np.float32)[None, :, None]
+        self.grid_x = np.arange(x0, x1, dtype=np.float32)[None, None, :]
+
+
+    def seed(self, entropy):
+        # default Generator for calls that do not pass an explicit rng
+        self.rng = np.random.default_rng(entropy)
 
     def create_canvas(self, background=(0, 0, 0)):
         img = np.uint8(np.zeros((self.height, self.width, 3)))
@@ -46,14 +207,15 @@ class CreateObject(object):
         return img 
 
 
-    def create_square(self, background=(255, 255, 255)):
+    def create_square(self, background=(255, 255, 255), rng=None):
+        rng = self.rng if rng is None else rng
         img = self.create_canvas()
-        object_height = np.random.randint(self.min_object, self.max_object)
-        object_width = np.random.randint(self.min_object, self.max_object)
+        object_height = rng.integers(self.min_object, self.max_object)
+        object_width = rng.integers(self.min_object, self.max_object)
 
         start_point = (int(self.width//2 - object_width//2), int(self.height//2 - object_height//2))
         end_point = (int(self.width//2 + object_width//2), int(self.height//2 + object_height//2))
-        color = tuple([int(a) for a in np.random.randint(150, 255, 3)])
+        color = tuple([int(a) for a in rng.integers(150, 255, 3)])
 
         img = cv2.rectangle(img, 
                 start_point, 
@@ -63,16 +225,17 @@ class CreateObject(object):
         return img
 
 
-    def create_triangle(self, background=(255, 255, 255)):
+    def create_triangle(self, background=(255, 255, 255), rng=None):
+        rng = self.rng if rng is None else rng
 
         img = self.create_canvas()
 
-        p1  = (np.random.randint(-self.max_object, self.max_object), 
-                        np.random.randint(-self.max_object, self.max_object))
-        p2  = (np.random.randint(-self.max_object, self.max_object), 
-                        np.random.randint(-self.max_object, self.max_object))
-        p3  = (np.random.randint(-self.max_object, self.max_object), 
-                        np.random.randint(-self.max_object, self.max_object))
+        p1  = (rng.integers(-self.max_object, self.max_object), 
+                        rng.integers(-self.max_object, self.max_object))
+        p2  = (rng.integers(-self.max_object, self.max_object), 
+                        rng.integers(-self.max_object, self.max_object))
+        p3  = (rng.integers(-self.max_object, self.max_object), 
+                        rng.integers(-self.max_object, self.max_object))
         
 
         # translate points to center
@@ -82,17 +245,18 @@ class CreateObject(object):
 
 
         triangle_contour = np.array([p1, p2, p3])
-        color = tuple([int(a) for a in np.random.randint(150, 255, 3)])
+        color = tuple([int(a) for a in rng.integers(150, 255, 3)])
 
         cv2.drawContours(img, [triangle_contour], 0, color, -1)
         return img
 
 
     def create_polygon(self, side=6):
-        def create_object(background=(255, 255, 255)):
+        def create_object(background=(255, 255, 255), rng=None):
+            rng = self.rng if rng is None else rng
             img = self.create_canvas()
-            sizex = np.random.randint(self.min_object, self.max_object)
-            sizey = np.random.randint(self.min_object, self.max_object)
+            sizex = rng.integers(self.min_object, self.max_object)
+            sizey = rng.integers(self.min_object, self.max_object)
             points = [ (int((math.cos(th) + 1) * sizex), int((math.sin(th) + 1) * sizey))
                 for th in [i * (2 * math.pi) / side for i in range(side)]
                 ]  
@@ -100,33 +264,35 @@ class CreateObject(object):
             contour = np.array(points)
             contour[:, 0] += int(self.width//2 - self.max_object//2)
             contour[:, 1] += int(self.height//2 - self.max_object//2)
-            color = tuple([int(a) for a in np.random.randint(150, 255, 3)])
+            color = tuple([int(a) for a in rng.integers(150, 255, 3)])
 
             cv2.drawContours(img, [contour], 0, color, -1)
             return img
         return create_object
 
 
-    def create_circle(self, background=(255, 255, 255)):
+    def create_circle(self, background=(255, 255, 255), rng=None):
+        rng = self.rng if rng is None else rng
         img = self.create_canvas()
 
-        radius = int(np.random.randint(self.min_object, self.max_object))
+        radius = int(rng.integers(self.min_object, self.max_object))
         center = (int(self.height//2), int(self.width//2))
-        color = tuple([int(a) for a in np.random.randint(150, 255, 3)])
+        color = tuple([int(a) for a in rng.integers(150, 255, 3)])
         cv2.circle(img, center, radius, color, -1)
         return img
 
 
-    def create_capsule(self, background=(255, 255, 255)):
+    def create_capsule(self, background=(255, 255, 255), rng=None):
+        rng = self.rng if rng is None else rng
 
         img = self.create_canvas()
 
-        object_height = np.random.randint(2*self.min_object, self.max_object)
-        object_width = np.random.randint(self.min_object, self.max_object)
+        object_height = rng.integers(self.min_long, self.max_object)
+        object_width = rng.integers(self.min_object, self.max_object)
 
         start_point = (int(self.width//2 - object_width//2), int(self.height//2 - object_height//2))
         end_point = (int(self.width//2 + object_width//2), int(self.height//2 + object_height//2))
-        color = tuple([int(a) for a in np.random.randint(150, 255, 3)])
+        color = tuple([int(a) for a in rng.integers(150, 255, 3)])
         img = cv2.rectangle(img, 
                 pt1=start_point, 
                 pt2=end_point, 
@@ -142,18 +308,19 @@ class CreateObject(object):
         return img
 
 
-    def create_ellipse(self, background=(255, 255, 255)):
+    def create_ellipse(self, background=(255, 255, 255), rng=None):
+        rng = self.rng if rng is None else rng
 
         img = self.create_canvas()
 
-        major_axis = int(np.random.randint(2*self.min_object, self.max_object))
-        minor_axis = int(np.random.randint(self.min_object, self.max_object))
+        major_axis = int(rng.integers(self.min_long, self.max_object))
+        minor_axis = int(rng.integers(self.min_object, self.max_object))
 
         center = (int(self.height//2), int(self.width//2))
         axesLength = (major_axis, minor_axis)
         
-        angle = int(np.random.uniform(0, 360))
-        color = tuple([int(a) for a in np.random.randint(150, 255, 3)])
+        angle = int(rng.uniform(0, 360))
+        color = tuple([int(a) for a in rng.integers(150, 255, 3)])
 
         cv2.ellipse(img, 
                     center, 
@@ -166,82 +333,495 @@ class CreateObject(object):
         return img 
 
 
-    def sample(self, n = 100, type='circle'):
+    # Batched primitives are described by per-row spans: for object i and
+    # window row y the shape covers xl[i, y] <= x <= xr[i, y]. Every shape we
+    # draw is convex along rows, so unions are a min/max of the spans.
+    def spans_circle(self, cx, cy, radius):
+        d = radius[:, None]**2 - (self.grid_y[0, :, 0][None] - cy[:, None])**2
+        half = np.sqrt(np.maximum(d, 0))
+        xl = np.where(d >= 0, cx[:, None] - half, np.inf)
+        xr = np.where(d >= 0, cx[:, None] + half, -np.inf)
+        return xl, xr
+
+
+    def spans_rectangle(self, object_height, object_width):
+        gy = self.grid_y[0, :, 0][None]
+        x0 = (self.width//2 - object_width//2)[:, None]
+        x1 = (self.width//2 + object_width//2)[:, None]
+        y0 = (self.height//2 - object_height//2)[:, None]
+        y1 = (self.height//2 + object_height//2)[:, None]
+        inside = (gy >= y0) & (gy <= y1)
+        return np.where(inside, x0, np.inf), np.where(inside, x1, -np.inf)
+
+
+    def draw(self, fn, n, rng):
+        # fn(n, rng) -> tuple of (n, ...) arrays. rng is either one Generator
+        # for all n items or a list of n Generators, one per item, so that
+        # every image can be reproduced from its own stream
+        if isinstance(rng, (list, tuple)):
+            return tuple(np.concatenate(a) for a in zip(*[fn(1, r) for r in rng]))
+        return fn(n, rng)
+
+
+    def draw_circle(self, n, rng):
+        return (rng.integers(self.min_object, self.max_object, n),)
+
+
+    def draw_sizes(self, n, rng):
+        return (rng.integers(self.min_object, self.max_object, (n, 2)),)
+
+
+    def draw_capsule(self, n, rng):
+        return (rng.integers(self.min_long, self.max_object, n),
+                rng.integers(self.min_object, self.max_object, n))
+
+
+    def draw_ellipse(self, n, rng):
+        return (rng.integers(self.min_long, self.max_object, n),
+                rng.integers(self.min_object, self.max_object, n),
+                rng.uniform(0, 360, n).astype(int))
+
+
+    def draw_color(self, n, rng):
+        return (rng.integers(150, 255, (n, 3)),)
+
+
+    def mask_circle(self, radius):
+        cx = np.full(len(radius), self.height//2)
+        cy = np.full(len(radius), self.width//2)
+        return self.spans_circle(cx, cy, radius)
+
+
+    def mask_square(self, sizes):
+        return self.spans_rectangle(sizes[:, 0], sizes[:, 1])
+
+
+    def mask_capsule(self, object_height, object_width):
+        xl, xr = self.spans_rectangle(object_height, object_width)
+
+        radius = object_width//2
+        cx = self.width//2 - object_width//2 + object_width//2
+        for cy in (self.height//2 - object_height//2, self.height//2 + object_height//2):
+            cl, cr = self.spans_circle(cx, cy, radius)
+            xl, xr = np.minimum(xl, cl), np.maximum(xr, cr)
+        return xl, xr
+
+
+    def mask_ellipse(self, major_axis, minor_axis, angle):
+        major_axis = major_axis[:, None]
+        minor_axis = minor_axis[:, None]
+        angle = np.deg2rad(angle)[:, None]
+
+        # rotated ellipse A dx^2 + B dx dy + C dy^2 <= 1, solved for dx per row
+        cos, sin = np.cos(angle), np.sin(angle)
+        A = cos**2/major_axis**2 + sin**2/minor_axis**2
+        B = 2*cos*sin*(1.0/major_axis**2 - 1.0/minor_axis**2)
+        C = sin**2/major_axis**2 + cos**2/minor_axis**2
+        dy = self.grid_y[0, :, 0][None] - self.width//2
+        disc = (B*dy)**2 - 4*A*(C*dy**2 - 1)
+        root = np.sqrt(np.maximum(disc, 0))
+        xl = np.where(disc >= 0, self.height//2 + (-B*dy - root)/(2*A), np.inf)
+        xr = np.where(disc >= 0, self.height//2 + (-B*dy + root)/(2*A), -np.inf)
+        return xl, xr
+
+
+    def mask_polygon(self, side=6):
+        theta = np.arange(side)*(2*math.pi)/side
+        def create_mask(sizes):
+            n = len(sizes)
+            px = ((np.cos(theta) + 1)[None]*sizes[:, :1]).astype(int) + int(self.width//2 - self.max_object//2)
+            py = ((np.sin(theta) + 1)[None]*sizes[:, 1:]).astype(int) + int(self.height//2 - self.max_object//2)
+
+            # intersect every row with every non horizontal edge
+            gy = self.grid_y[0, :, 0][None]
+            xl = np.full((n, gy.shape[1]), np.inf)
+            xr = np.full((n, gy.shape[1]), -np.inf)
+            for k in range(side):
+                x0, y0 = px[:, k, None], py[:, k, None]
+                x1, y1 = px[:, (k + 1) % side, None], py[:, (k + 1) % side, None]
+                dy = np.where(y1 == y0, 1, y1 - y0)
+                t = (gy - y0)/dy
+                x = np.where((t >= 0) & (t <= 1) & (y1 != y0), x0 + t*(x1 - x0), np.nan)
+                xl, xr = np.fmin(xl, x), np.fmax(xr, x)
+            return xl, xr
+        return create_mask
+
+
+    def coverage(self, spans):
+        xl, xr = spans
+        gx = self.grid_x
+        return (gx >= xl[:, :, None].astype(np.float32)) & (gx <= xr[:, :, None].astype(np.float32))
+
+
+    def sample_sprites(self, n = 100, type='circle', rng=None):
+        if not (type in self.batch_masks.keys()):
+            raise ValueError('Unkown type found, allowed types: ', self.batch_masks.keys())
+
+        rng = self.rng if rng is None else rng
+        n = len(rng) if isinstance(rng, (list, tuple)) else n
+        params = self.draw(self.batch_params[type], n, rng)
+        colors = self.draw(self.draw_color, n, rng)[0].astype(np.uint8)
+        masks = self.coverage(self.batch_masks[type](*params))
+
+        y0, y1, x0, x1 = self.window
+        pixels = np.empty((n, y1 - y0, x1 - x0, 4), dtype=np.uint8)
+        alpha = masks.view(np.uint8)
+        for c in range(3):
+            np.multiply(alpha, colors[:, c, None, None], out=pixels[..., c])
+        np.multiply(alpha, 255, out=pixels[..., 3])
+
+        boxes = mask_boxes(masks)
+        boxes[:, :2] += y0
+        boxes[:, 2:] += x0
+        return Sprites(pixels, (y0, x0), boxes, type)
+
+
+    def sample_batch(self, n = 100, type='circle', rng=None):
+        sprites = self.sample_sprites(n, type, rng)
+
+        y0, y1, x0, x1 = self.window
+        objects = np.zeros((len(sprites), self.height, self.width, 3), dtype=np.uint8)
+        objects[:, y0:y1, x0:x1] = sprites.pixels[..., :3]
+        return objects
+
+
+    def draw_placement(self, n, K, rotate, rng):
+        # (n, K) slots, rotation and shear (degrees) and translation (pixels)
+        # of the K objects of n images; every image uses a random permutation
+        # of the translate slots
+        slots = np.argsort(rng.random((n, len(self.translate))), axis=1)[:, :K] + 1
+        r = np.zeros((n, K))
+        sh = np.zeros((n, K))
+        if rotate:
+            r = rng.uniform(*self.rotate, (n, K))
+            sh = rng.uniform(*self.shear, (n, K))
+
+        tx = np.zeros((n, K))
+        ty = np.zeros((n, K))
+        for k, ranges in self.translate.items():
+            idx = slots == k
+            tx[idx] = rng.uniform(*ranges["x"], idx.sum())*self.width
+            ty[idx] = rng.uniform(*ranges["y"], idx.sum())*self.height
+        return slots, r, sh, tx, ty
+
+
+    def affine_matrices(self, rotate, shear, tx, ty):
+        # forward (..., 2, 3) matrices: rotate + shear about the pixel centre
+        # of the canvas, then shift by (tx, ty)
+        r = np.deg2rad(rotate)
+        sh = np.deg2rad(shear)
+        matrices = np.zeros(r.shape + (2, 3))
+        matrices[..., 0, 0] = np.cos(r)
+        matrices[..., 0, 1] = -np.sin(r + sh)
+        matrices[..., 1, 0] = np.sin(r)
+        matrices[..., 1, 1] = np.cos(r + sh)
+
+        cx, cy = self.width/2.0 - 0.5, self.height/2.0 - 0.5
+        matrices[..., 0, 2] = cx - matrices[..., 0, 0]*cx - matrices[..., 0, 1]*cy + tx
+        matrices[..., 1, 2] = cy - matrices[..., 1, 0]*cx - matrices[..., 1, 1]*cy + ty
+        return matrices
+
+
+    def timer(self, name):
+        return nullcontext() if self.metrics is None else self.metrics.timer(name)
+
+    def buffer(self, name, shape, dtype):
+        # scratch arrays reused across batches, a smaller batch (like the
+        # last sub-batch of a class) gets a leading slice of a larger one.
+        # Every thread has its own, so a stream() thread and get() calls on
+        # the same dataset never share one
+        buffers = self.buffers.setdefault(threading.get_ident(), {})
+        array = buffers.get(name)
+        if array is None or array.shape[1:] != shape[1:] or len(array) < shape[0] or array.dtype != dtype:
+            array = buffers[name] = np.empty(shape, dtype=dtype)
+        return array[:shape[0]]
+
+
+    def noise_batch(self, images, rng=None):
+        # images + gaussian noise shared by the channels of a pixel, clipped
+        # and truncated like a uint8 cast, in a reused float32 buffer
+        rng = self.rng if rng is None else rng
+        noise = self.buffer('noise', images.shape[:-1] + (1,), np.float32)
+        if isinstance(rng, (list, tuple)):
+            for bi, r in enumerate(rng):
+                r.standard_normal(out=noise[bi], dtype=np.float32)
+        else:
+            rng.standard_normal(out=noise, dtype=np.float32)
+        noise *= self.noise_scale
+
+        work = self.buffer('work', images.shape, np.float32)
+        np.copyto(work, images)
+        work += noise
+        np.clip(work, 0, 255, out=work)
+        np.floor(work, out=work)
+        return work
+
+
+    def normalize_batch(self, work, background, out=None):
+        # background where nothing was drawn (< 10), then a per-image min-max
+        # stretch to uint8. Values are integers <= 263, so float32 floors
+        # them exactly like the float64 formula did
+        empty = self.buffer('empty', work.shape, bool)
+        np.less(work, 10, out=empty)
+        np.add(work, np.float32(background), out=work, where=empty)
+
+        low = work.min(axis=(1, 2, 3), keepdims=True)
+        high = work.max(axis=(1, 2, 3), keepdims=True)
+        work -= low
+        work *= 255
+        work /= np.maximum(high - low, 1)
+        if out is None:
+            out = np.empty(work.shape, dtype=np.uint8)
+        np.copyto(out, work, casting='unsafe')
+        return out
+
+
+    def noise_aug(self, image, rng=None):
+        # additive gaussian noise on a single image
+        return np.uint8(self.noise_batch(image[None], rng)[0])
+
+
+    def warp(self, objects, matrices, border_mode=cv2.BORDER_CONSTANT):
+        warped = np.empty_like(objects)
+        for i in range(len(objects)):
+            cv2.warpAffine(objects[i], matrices[i], (self.width, self.height),
+                            dst=warped[i],
+                            flags=cv2.INTER_LINEAR,
+                            borderMode=border_mode)
+        return warped
+
+
+    def paste(self, canvas, sprites, i, matrix):
+        # warp only the object's box to its footprint and blend it there
+        y0, y1, x0, x1 = sprites.boxes[i]
+        if y1 <= y0 or x1 <= x0:
+            return None
+
+        corners = np.array([[x0, y0], [x1, y0], [x0, y1], [x1, y1]], dtype=float)
+        xy = corners @ matrix[:, :2].T + matrix[:, 2]
+        dx0 = max(int(np.floor(xy[:, 0].min())) - 1, 0)
+        dx1 = min(int(np.ceil(xy[:, 0].max())) + 1, self.width)
+        dy0 = max(int(np.floor(xy[:, 1].min())) - 1, 0)
+        dy1 = min(int(np.ceil(xy[:, 1].max())) + 1, self.height)
+        if dy1 <= dy0 or dx1 <= dx0:
+            return None
+
+        oy, ox = sprites.origin
+        tile = sprites.pixels[i, y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+        tile_matrix = matrix.copy()
+        tile_matrix[:, 2] += matrix[:, :2] @ (x0, y0) - (dx0, dy0)
+        tile = cv2.warpAffine(tile, tile_matrix, (dx1 - dx0, dy1 - dy0),
+                                flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_CONSTANT)
+
+        region = canvas[dy0:dy1, dx0:dx1]
+        alpha = tile[..., 3:].astype(np.uint16)
+        blended = tile[..., :3] + (region*(255 - alpha) + 127)//255
+        np.minimum(blended, 255, out=blended)
+        region[...] = blended
+        return dy0, dx0, tile[..., 3]
+
+
+    def sample(self, n = 100, type='circle', transform=True, rng=None):
         if not (type in self.objects.keys()): 
             raise ValueError('Unkown type found, allowed types: ', self.objects.keys())
 
-        objects = [self.objects[type]() for _ in range(n)]
-        objects = self.transform(images = objects)
-        return np.array(objects)
-
-    def combine(self, concepts,  background=(255, 255, 255)):
-        data = np.zeros_like(concepts[0])*1.0
-        data[..., 0] =  background[0]
-        data[..., 1] =  background[1]
-        data[..., 2] =  background[2]
-
-        concepts = np.array(concepts)
-        concepts = concepts.transpose(1, 0, 2, 3, 4)
-
-        translate_order = [1, 2, 3, 4, 5]
-        N = concepts.shape[1]
-        for bi, iconcept in enumerate(concepts):
-            np.random.shuffle(translate_order)
-            combined = np.zeros_like(iconcept[0])
-            for i, concept in enumerate(iconcept):
-                combined_ = self.translate[translate_order[i]](image = concept)
-                combined = combined*(combined_ < 10) + combined_
-
-            combined = self.noise_aug(image = np.uint8(combined))
-            data[bi, ...] = data[bi, ...]*(combined < 10) + combined
-            data[bi, ...] = 255*(data[bi, ...] - np.min(data[bi, ...]))/(np.max(data[bi, ...]) - np.min(data[bi, ...]))
-
-        # data = np.clip(data, 0, 255)
-        data = np.uint8(data)
-        return data 
-
-
-
-def show_image(images, 
-                title=('original img', 'recon img', 'intervened img'),
-                transpose = False):
-    
-    img_size = 3
-    nrows = len(images)
-    ncols = len(images[0])
-
-    if transpose:
-        ncols = len(images)
-        nrows = len(images[0])
-                
-
-    nimgs = nrows*ncols
-    
-    plt.clf()
-    fig = plt.figure(num = nimgs, figsize=(img_size*ncols, img_size*nrows))
-    fig.tight_layout()
-    gs = gridspec.GridSpec(nrows, ncols)
-    gs.update(wspace=0.2, hspace=0.1)
-
-    for ilist, img_set in enumerate(images):
-
-        for iset, img in enumerate(img_set):
-            xidx = ilist; yidx = iset 
-            if transpose:
-                yidx = ilist; xidx = iset
-
-            ax = plt.subplot(gs[xidx, yidx])
-            ax.imshow(img)
-
-                
-            ax.set_xticklabels([])
-            ax.set_yticklabels([])
-            ax.set_aspect('equal')
-            ax.set_title('$'+title[ilist]+'$')
-            ax.tick_params(bottom='off', top='off', labelbottom='off', right='off', left='off', labelleft='off' )
-
+        rng = self.rng if rng is None else rng
+        objects = self.sample_batch(n, type, rng)
+        if transform:
+            rotate = rng.uniform(*self.rotate, len(objects))
+            shear = rng.uniform(*self.shear, len(objects))
+            matrices = self.affine_matrices(rotate, shear, 0, 0)
+            objects = self.warp(objects, matrices, self.border_mode)
+        return objects
+
+    def annotate(self, pasted):
+        # tight canvas box and packed mask (coverage >= 128, before occlusion
+        # by later objects) of a paste()/paste_tile() result
+        if pasted is None:
+            return (0, 0, 0, 0), np.empty(0, np.uint8)
+        y, x, alpha = pasted
+        mask = alpha >= 128
+        y0, y1, x0, x1 = mask_boxes(mask[None])[0]
+        return (y + y0, y + y1, x + x0, x + x1), np.packbits(mask[y0:y1, x0:x1])
+
+    def composite(self, concepts, matrices, bi, out=None, annotations=None):
+        # objects of image bi blended in order over a black canvas; with an
+        # annotations list, (k, box, bits) of every object is appended to it
+        if out is None:
+            out = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        out.fill(0)
+        for k, sprites in enumerate(concepts):
+            pasted = self.paste(out, sprites, bi, matrices[k])
+            if annotations is not None:
+                annotations.append((k, *self.annotate(pasted)))
+        return out
+
+    def combine(self, concepts,  background=(255, 255, 255), transform=False, rng=None, annotate=False):
+        # concepts: K Sprites (or (B, H, W, 3) frames), one object per image each;
+        # transform=True expects untransformed sample_sprites objects and
+        # applies rotation, shear and translation in one warp. rng is a
+        # Generator or a list of B per-image Generators. annotate=True returns
+        # (images, pack_annotations(...)) with mask, box, type and slot of
+        # every object
+        rng = self.rng if rng is None else rng
+        concepts = [c if isinstance(c, Sprites) else Sprites.from_frames(c) for c in concepts]
+        B, K = len(concepts[0]), len(concepts)
+
+        placement = self.draw(lambda n, r: self.draw_placement(n, K, transform, r), B, rng)
+        matrices = self.affine_matrices(*placement[1:])
+
+        combined = self.buffer('combined', (B, self.height, self.width, 3), np.uint8)
+        objects = [] if annotate else None
+        with self.timer('composite'):
+            for bi in range(B):
+                pasted = [] if annotate else None
+                self.composite(concepts, matrices[bi], bi, out=combined[bi], annotations=pasted)
+                if annotate:
+                    slots = placement[0][bi]
+                    objects.extend((bi, k, concepts[k].type, slots[k], box, bits) for k, box, bits in pasted)
+        with self.timer('postprocess'):
+            images = self.postprocess(combined, background, rng)
+        return (images, pack_annotations(objects)) if annotate else images
+
+    def postprocess(self, combined, background, rng):
+        # noise and normalization in chunks of about chunk_bytes of float32 scratch
+        B = len(combined)
+        data = np.empty((B, self.height, self.width, 3), dtype=np.uint8)
+        step = max(1, self.chunk_bytes//(4*self.height*self.width*3))
+        for start in range(0, B, step):
+            chunk = slice(start, start + step)
+            rng_ = rng[chunk] if isinstance(rng, (list, tuple)) else rng
+            work = self.noise_batch(combined[chunk], rng_)
+            self.normalize_batch(work, background, out=data[chunk])
+        return data
+
+
+    # sprite_bank mode: every concept type is rendered and rotated/sheared
+    # once into a bank of variants, images are then built from bank tiles
+    # with a random variant, colour and slot translation per object, so the
+    # steady state is tile copies and blending only
+    def params(self):
+        # everything besides the seeds that shapes the rendered images
+        return {'types': list(self.objects.keys()),
+                'height': self.height,
+                'width': self.width,
+                'min_object': self.min_object,
+                'max_object': self.max_object,
+                'min_long': self.min_long,
+                'rotate': list(self.rotate),
+                'shear': list(self.shear),
+                'border_mode': int(self.border_mode),
+                'translate': self.translate,
+                'noise_scale': self.noise_scale}
+
+    def bank_meta(self, size, seed):
+        return {'version': 1,
+                'types': list(self.objects.keys()),
+                'height': self.height,
+                'width': self.width,
+                'size': size,
+                'seed': seed,
+                'min_object': self.min_object,
+                'max_object': self.max_object,
+                'min_long': self.min_long,
+                'rotate': list(self.rotate),
+                'shear': list(self.shear)}
+
+    def load_bank(self, size=256, cache_dir=None, seed=0):
+        # switch to sprite_bank mode with size variants per type, loaded from
+        # cache_dir when a bank of the same parameters was built before
+        meta = self.bank_meta(size, seed)
+        path = None
+        if cache_dir is not None:
+            digest = hashlib.sha1(json.dumps(meta, sort_keys=True).encode()).hexdigest()[:16]
+            path = os.path.join(cache_dir, f'bank-{self.height}x{self.width}-{size}-{digest}.npz')
+            self.bank = SpriteBank.load(path, meta)
+            if self.bank is not None:
+                return self.bank
+
+        self.bank = self.build_bank(size, np.random.default_rng(seed))
+        self.bank.meta = meta
+        if path is not None:
+            self.bank.save(path)
+        return self.bank
+
+    def build_bank(self, size, rng):
+        tiles, boxes = {}, {}
+        for type_ in self.objects:
+            sprites = self.sample_sprites(size, type_, rng)
+            rotate = rng.uniform(*self.rotate, size)
+            shear = rng.uniform(*self.shear, size)
+            matrices = self.affine_matrices(rotate, shear, 0, 0)
+
+            canvas = np.zeros((self.height, self.width), dtype=np.uint8)
+            oy, ox = sprites.origin
+            variants = []
+            for i in range(size):
+                canvas.fill(0)
+                y0, y1, x0, x1 = sprites.boxes[i]
+                canvas[y0:y1, x0:x1] = sprites.pixels[i, y0 - oy:y1 - oy, x0 - ox:x1 - ox, 3]
+                warped = cv2.warpAffine(canvas, matrices[i], (self.width, self.height),
+                                        flags=cv2.INTER_LINEAR,
+                                        borderMode=cv2.BORDER_CONSTANT)
+                wy0, wy1, wx0, wx1 = mask_boxes(warped[None] > 0)[0]
+                variants.append((warped[wy0:wy1, wx0:wx1], (wy0, wx0, wy1 - wy0, wx1 - wx0)))
+
+            boxes[type_] = np.array([box for _, box in variants], dtype=np.int32)
+            th, tw = boxes[type_][:, 2].max(), boxes[type_][:, 3].max()
+            tiles[type_] = np.zeros((size, th, tw), dtype=np.uint8)
+            for i, (tile, (_, _, h, w)) in enumerate(variants):
+                tiles[type_][i, :h, :w] = tile
+        return SpriteBank(tiles, boxes)
+
+    def draw_bank(self, n, types, rng):
+        # variant, colour, slot and translation of the K objects of n images
+        K = len(types)
+        variants = np.stack([rng.integers(0, len(self.bank.tiles[t]), n) for t in types], axis=1)
+        colors = rng.integers(150, 255, (n, K, 3))
+        slots, _, _, tx, ty = self.draw_placement(n, K, False, rng)
+        return variants, colors, slots, tx, ty
+
+    def paste_tile(self, canvas, alpha, color, y, x):
+        # blend colour with coverage alpha into canvas at corner (y, x)
+        h, w = alpha.shape
+        cy0, cy1 = max(y, 0), min(y + h, self.height)
+        cx0, cx1 = max(x, 0), min(x + w, self.width)
+        if cy1 <= cy0 or cx1 <= cx0:
+            return None
+        alpha = alpha[cy0 - y:cy1 - y, cx0 - x:cx1 - x]
+        a = alpha[..., None].astype(np.uint16)
+        region = canvas[cy0:cy1, cx0:cx1]
+        region[...] = (color*a + region*(255 - a) + 127)//255
+        return cy0, cx0, alpha
+
+    def combine_bank(self, types, n=1, background=(255, 255, 255), rng=None, annotate=False):
+        # n images with one object of every type in types taken from the bank;
+        # rng and annotate work like in combine
+        if self.bank is None:
+            raise ValueError('no sprite bank loaded, call load_bank first')
+        rng = self.rng if rng is None else rng
+        n = len(rng) if isinstance(rng, (list, tuple)) else n
+        variants, colors, slots, tx, ty = self.draw(lambda m, r: self.draw_bank(m, types, r), n, rng)
+        dy, dx = np.rint(ty).astype(int), np.rint(tx).astype(int)
+        colors = colors.astype(np.uint16)
+
+        combined = self.buffer('combined', (n, self.height, self.width, 3), np.uint8)
+        combined.fill(0)
+        objects = []
+        for k, type_ in enumerate(types):
+            tiles, boxes = self.bank.tiles[type_], self.bank.boxes[type_]
+            with self.timer(f'concept.{type_}'):
+                for bi in range(n):
+                    v = variants[bi, k]
+                    y, x, h, w = boxes[v]
+                    pasted = self.paste_tile(combined[bi], tiles[v, :h, :w], colors[bi, k], y + dy[bi, k], x + dx[bi, k])
+                    if annotate:
+                        objects.append((bi, k, type_, slots[bi, k], *self.annotate(pasted)))
+        with self.timer('postprocess'):
+            images = self.postprocess(combined, background, rng)
+        if not annotate:
+            return images
+        objects.sort(key=lambda o: (o[0], o[1]))
+        return images, pack_annotations(objects)
 
-        
-    plt.tight_layout()
-    plt.savefig('test.png')
-    plt.show()
\ No newline at end of file
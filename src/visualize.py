@@ -0,0 +1,88 @@
+import os
+import cv2
+import numpy as np
+
+
+def as_uint8(image):
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = np.clip(image, 0, 255).astype(np.uint8)
+    if image.ndim == 2:
+        image = np.repeat(image[..., None], 3, axis=-1)
+    return image
+
+
+def montage(images, ncols=None, padding=2, pad_value=255, labels=None, scale=1):
+    # one uint8 grid of a (N, H, W, 3) batch, ncols per row (about square by
+    # default), or of a list of batches with one batch per row. labels is a
+    # string per image (or per row for a list of batches) drawn in the top
+    # left corner of its tiles; scale enlarges the tiles by pixel repetition
+    if isinstance(images, (list, tuple)):
+        rows = [as_uint8(row) for row in images]
+        ncols = max(len(row) for row in rows)
+        if labels is not None:
+            labels = list(labels) + [None]*(len(rows) - len(labels))
+            labels = [label for row, label in zip(rows, labels) for _ in range(ncols)]
+        blank = np.full(rows[0].shape[1:], pad_value, dtype=np.uint8)
+        images = np.stack([row[i] if i < len(row) else blank for row in rows for i in range(ncols)])
+    else:
+        images = as_uint8(images)
+        if ncols is None:
+            ncols = int(np.ceil(np.sqrt(len(images))))
+
+    n, H, W, C = images.shape
+    nrows = -(-n//ncols)
+    # pad every tile on its bottom/right, then interleave tile rows and columns
+    tiles = np.full((nrows*ncols, H + padding, W + padding, C), pad_value, dtype=np.uint8)
+    tiles[:n, :H, :W] = images
+    grid = tiles.reshape(nrows, ncols, H + padding, W + padding, C).transpose(0, 2, 1, 3, 4)
+    grid = grid.reshape(nrows*(H + padding), ncols*(W + padding), C)
+    grid = np.pad(grid, ((padding, 0), (padding, 0), (0, 0)), constant_values=pad_value)
+
+    if scale != 1:
+        grid = np.repeat(np.repeat(grid, scale, axis=0), scale, axis=1)
+    if labels is not None:
+        font = max(0.3, 0.25*scale*min(H, W)/64)
+        for i, label in enumerate(labels[:n]):
+            if label is None or label == '':
+                continue
+            r, c = divmod(i, ncols)
+            origin = (scale*(padding + c*(W + padding)) + 2, scale*(padding + r*(H + padding)) + int(12*font/0.3))
+            cv2.putText(grid, str(label), origin, cv2.FONT_HERSHEY_SIMPLEX, font, (0, 0, 0), 3, cv2.LINE_AA)
+            cv2.putText(grid, str(label), origin, cv2.FONT_HERSHEY_SIMPLEX, font, (255, 255, 255), 1, cv2.LINE_AA)
+    return grid
+
+
+def save_montage(path, images, **kwargs):
+    # montage(images, **kwargs) written with cv2, images are BGR like the
+    # generator output
+    grid = montage(images, **kwargs)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if not cv2.imwrite(path, grid):
+        raise IOError(f'could not write {path}')
+    return grid
+
+
+def show_image(images,
+                title=('original img', 'recon img', 'intervened img'),
+                transpose = False,
+                path='test.png',
+                show=True):
+    # rows of images (one list or batch per row) with one title per row,
+    # written to path as a single montage and, like before, displayed with
+    # matplotlib, which is only imported then. show=False only writes it,
+    # e.g. on headless nodes
+    rows = [as_uint8(row) for row in images]
+    labels = list(title)
+    if transpose:
+        rows = [np.stack(column) for column in zip(*rows)]
+        labels = None
+
+    grid = save_montage(path, rows, labels=labels)
+    if show:
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(grid.shape[1]/100, grid.shape[0]/100))
+        plt.imshow(grid[..., ::-1])
+        plt.axis('off')
+        plt.show()
+    return grid
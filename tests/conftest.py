@@ -0,0 +1,5 @@
+import os
+import sys
+
+# tests import the package as `src`, like `python -m src.main` does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
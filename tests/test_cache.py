@@ -0,0 +1,64 @@
+import os
+import numpy as np
+from src.cache import DatasetCache
+from src.main import CreateDataset
+from src.storage import NpyReader
+
+SMALL = dict(N=48, batch_size=8, height=32, width=32, seed=3, writer_threads=0, backend='npy', shard_size=16)
+
+
+def make(tmp_path, name, **kwargs):
+    return CreateDataset(save_dir=str(tmp_path/name), cache_dir=str(tmp_path/'cache'), **dict(SMALL, **kwargs))
+
+
+def test_key_covers_the_output_only(tmp_path):
+    key = make(tmp_path, 'a').cache_key()
+    assert make(tmp_path, 'b', workers=2, writer_threads=2).cache_key() == key
+    assert make(tmp_path, 'c', seed=4).cache_key() != key
+    assert make(tmp_path, 'd', shard_size=64).cache_key() != key
+    assert make(tmp_path, 'e', backend='png').cache_key() != key
+
+
+def test_hit_serves_the_same_dataset(tmp_path):
+    assert not make(tmp_path, 'a').create()['cached']
+    report = make(tmp_path, 'b').create()
+    assert report['cached'] and report['completed'] == list(range(6))
+    a, b = NpyReader(str(tmp_path/'a')), NpyReader(str(tmp_path/'b'))
+    for x, y in zip(a.batch(0, len(a)), b.batch(0, len(b))):
+        assert (np.array(x) == np.array(y)).all()
+    assert not make(tmp_path, 'c', shard_size=64).create()['cached']
+
+
+def test_rewritten_save_dir_leaves_entry_intact(tmp_path):
+    make(tmp_path, 'a').create()
+    make(tmp_path, 'b').create()
+    # another dataset into the fetched folder, without the cache
+    CreateDataset(save_dir=str(tmp_path/'b'), **dict(SMALL, seed=9)).create()
+    assert make(tmp_path, 'c', cache_verify='full').create()['cached']
+
+
+def test_corrupt_entry_is_dropped(tmp_path):
+    dataset = make(tmp_path, 'a')
+    dataset.create()
+    cache = DatasetCache(str(tmp_path/'cache'))
+    entry = cache.entry(dataset.cache_key())
+    with open(os.path.join(cache.path(dataset.cache_key()), 'labels.npy'), 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\xff')
+    assert cache.verify(dataset.cache_key(), entry, 'size')
+    # the digest check drops the entry, the regenerated run stores a new one
+    assert not make(tmp_path, 'b', cache_verify='full').create()['cached']
+    assert make(tmp_path, 'c', cache_verify='full').create()['cached']
+
+
+def test_lru_eviction_under_quota(tmp_path):
+    for seed in (1, 2):
+        make(tmp_path, f's{seed}', seed=seed).create()
+    cache = DatasetCache(str(tmp_path/'cache'))
+    entries = cache.entries()
+    first = make(tmp_path, 'x', seed=1).cache_key()
+    # using seed 1 again makes seed 2 the least recently used
+    assert make(tmp_path, 'again', seed=1).create()['cached']
+    cache.quota = max(entry['bytes'] for entry in entries.values())
+    assert cache.evict() == [make(tmp_path, 'y', seed=2).cache_key()]
+    assert list(cache.entries()) == [first]
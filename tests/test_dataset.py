@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from src.main import CreateDataset
+from src.storage import NpyReader
+
+SMALL = dict(N=48, batch_size=8, height=32, width=32, seed=3, writer_threads=0)
+
+
+def test_resume_with_other_npy_shard_size_keeps_data(tmp_path):
+    save_dir = str(tmp_path/'npy')
+    CreateDataset(save_dir=save_dir, backend='npy', shard_size=16, **SMALL).create()
+    before = NpyReader(save_dir).batch(0, 8)[0].copy()
+    with pytest.raises(ValueError, match='different dataset'):
+        CreateDataset(save_dir=save_dir, backend='npy', shard_size=64, resume=True, **SMALL).create()
+    assert (NpyReader(save_dir).batch(0, 8)[0] == before).all()
+    assert before.mean() > 0
+
+
+def test_annotations_do_not_depend_on_sub_batching(tmp_path):
+    from src.storage import AnnotationReader
+    save_dir = str(tmp_path/'ann')
+    args = dict(SMALL, N=96, batch_size=16, annotations=True)
+    split = CreateDataset(save_dir=save_dir, **args)
+    # what a tight max_memory budget would pick
+    split.sub_batch = 5
+    split.create()
+    first = AnnotationReader(save_dir)
+    CreateDataset(save_dir=save_dir, **args).create()
+    second = AnnotationReader(save_dir)
+    assert len(first) == len(second)
+    for key in first.columns:
+        assert (first[key] == second[key]).all()
+    assert len(second.rows(10)) == len(set(second['order'][list(second.rows(10))]))
+
+
+def read_npy(save_dir):
+    reader = NpyReader(save_dir)
+    return [np.array(a) for a in reader.batch(0, len(reader))]
+
+
+def test_output_does_not_depend_on_workers(tmp_path):
+    outputs = []
+    for workers in (1, 3):
+        save_dir = str(tmp_path/f'w{workers}')
+        report = CreateDataset(save_dir=save_dir, backend='npy', workers=workers, **SMALL).create()
+        assert report['completed'] == list(range(6))
+        outputs.append(read_npy(save_dir))
+    for a, b in zip(*outputs):
+        assert (a == b).all()
+
+
+def test_resume_regenerates_only_missing_batches(tmp_path):
+    full = str(tmp_path/'full')
+    CreateDataset(save_dir=full, backend='npy', **SMALL).create()
+
+    # an interrupted run: batches 0 and 1 done, a torn record, no data after
+    save_dir = str(tmp_path/'resumed')
+    CreateDataset(save_dir=save_dir, backend='npy', **SMALL).create()
+    with open(f'{save_dir}/manifest.jsonl') as f:
+        lines = f.readlines()
+    with open(f'{save_dir}/manifest.jsonl', 'w') as f:
+        f.writelines(lines[:3] + [lines[3][:20]])
+    images = np.load(f'{save_dir}/images-00000.npy', mmap_mode='r+')
+    images[2*3*8:] = 0
+    # marks batch 0, which must not be written again
+    images[:8] = 7
+    images.flush()
+    del images
+
+    resumed = CreateDataset(save_dir=save_dir, backend='npy', resume=True, **dict(SMALL, seed=None))
+    assert resumed.seed == SMALL['seed']
+    report = resumed.create()
+    assert report['completed'] == list(range(6))
+    expected, got = read_npy(full), read_npy(save_dir)
+    assert (got[0][:8] == 7).all()
+    assert (got[0][8:] == expected[0][8:]).all()
+    for a, b in zip(expected[1:], got[1:]):
+        assert (a == b).all()
+
+
+def test_get_batch_matches_written_pngs(tmp_path):
+    import cv2
+    save_dir = str(tmp_path/'png')
+    dataset = CreateDataset(save_dir=save_dir, **SMALL)
+    dataset.create()
+    indices = [0, 5, 8, 23, 47, 100, 143]
+    images, labels, _ = dataset.get_batch(indices)
+    for image, label, index in zip(images, labels, indices):
+        written = cv2.imread(f'{save_dir}/class-{label}/{index}.png')
+        assert (written == image).all()
+        assert (dataset.get(index)[0] == image).all()
@@ -0,0 +1,101 @@
+import os
+import threading
+import numpy as np
+import pytest
+from src.ring import RingBuffer, RingConsumer, RingProducer
+
+B, H, W, K = 2, 4, 4, 3
+
+
+def batch(n):
+    return (np.full((B, H, W, 3), n % 256, dtype=np.uint8),
+            np.full(B, n % 7, dtype=np.uint8),
+            np.full((B, K), n % 5, dtype=np.uint8))
+
+
+@pytest.fixture
+def ring():
+    ring = RingBuffer.create(f'test-ring-{os.getpid()}', 3, B, H, W, K)
+    yield ring
+    ring.close()
+
+
+def produce(ring, producer_id, nproducers, stop):
+    producer = RingProducer(ring, producer_id)
+    for n in range(producer_id, stop, nproducers):
+        assert producer.write(n, *batch(n), timeout=10)
+
+
+def consume(ring, consumer_id, out):
+    consumer = RingConsumer(ring, consumer_id)
+    for images, labels, concepts in consumer:
+        n = consumer.position - 1
+        out.append(n)
+        assert (images == batch(n)[0]).all() and (labels == batch(n)[1]).all() and (concepts == batch(n)[2]).all()
+    consumer.close()
+
+
+@pytest.mark.parametrize('nproducers', [1, 2])
+def test_every_consumer_reads_every_batch_in_order(ring, nproducers):
+    stop = 20
+    ring.set_stop(stop)
+    outs = [[], []]
+    attached = RingBuffer.attach(ring.shm.name)
+    # consumers attach up front, producers wait for them
+    consumers = [threading.Thread(target=consume, args=(attached, i, outs[i])) for i in range(2)]
+    for thread in consumers:
+        thread.start()
+    producers = [threading.Thread(target=produce, args=(ring, p, nproducers, stop)) for p in range(nproducers)]
+    for thread in producers:
+        thread.start()
+    for thread in producers + consumers:
+        thread.join(20)
+    assert outs == [list(range(stop))]*2
+    assert ring.produced == stop
+    attached.close()
+
+
+def test_backpressure(ring):
+    consumer = RingConsumer(ring, 0)
+    producer = RingProducer(ring, 0)
+    for n in range(ring.nslots):
+        assert producer.write(n, *batch(n), timeout=1)
+    # batch 0 is unread, its slot can not be reused
+    assert not producer.write(ring.nslots, *batch(ring.nslots), timeout=0.1)
+    consumer.next(timeout=1)
+    consumer.next(timeout=1)
+    assert producer.write(ring.nslots, *batch(ring.nslots), timeout=1)
+    assert ring.produced == ring.nslots + 1
+
+
+def test_no_consumer_blocks_producer(ring):
+    assert not RingProducer(ring, 0).write(0, *batch(0), timeout=0.1)
+
+
+def test_late_consumer_starts_at_oldest_batch(ring):
+    first = RingConsumer(ring, 0)
+    producer = RingProducer(ring, 0)
+    for n in range(ring.nslots):
+        producer.write(n, *batch(n), timeout=1)
+    first.next(timeout=1)
+    first.next(timeout=1)
+    late = RingConsumer(ring, 1)
+    assert late.position == 1
+    assert late.next(timeout=1)[1][0] == batch(1)[1][0]
+
+
+def test_stop_and_shutdown(ring):
+    consumer = RingConsumer(ring, 0)
+    producer = RingProducer(ring, 0)
+    ring.set_stop(1)
+    producer.write(0, *batch(0), timeout=1)
+    consumer.next(timeout=1)
+    with pytest.raises(StopIteration):
+        consumer.next(timeout=1)
+
+    other = RingConsumer(ring, 1)
+    ring.set_stop(None)
+    ring.shutdown()
+    with pytest.raises(StopIteration):
+        other.next(timeout=1)
+    assert not producer.write(1, *batch(1), timeout=1)
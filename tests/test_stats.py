@@ -0,0 +1,22 @@
+import numpy as np
+from src.stats import Stats
+
+
+def test_sums_exact_beyond_float32():
+    # the background bin holds more than 2**24 pixels
+    images = np.full((20, 1024, 1024, 3), 7, dtype=np.uint8)
+    images[:, 0, 0] = (1, 2, 3)
+    entry = Stats().update(0, images).classes['0']
+    wide = images.astype(np.int64)
+    assert entry['sum'] == wide.sum(axis=(0, 1, 2)).tolist()
+    assert entry['sumsq'] == (wide**2).sum(axis=(0, 1, 2)).tolist()
+    assert entry['pixels'] == 20*1024*1024
+
+
+def test_merge_round_trip():
+    rng = np.random.default_rng(0)
+    a = rng.integers(0, 256, (4, 16, 16, 3), dtype=np.uint8)
+    b = rng.integers(0, 256, (3, 16, 16, 3), dtype=np.uint8)
+    merged = Stats().update(1, a, ['circle']).merge(Stats.from_dict(Stats().update(1, b, ['circle']).to_dict()))
+    whole = Stats().update(1, np.concatenate([a, b]), ['circle'])
+    assert merged.classes == whole.classes